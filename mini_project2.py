@@ -1,12 +1,59 @@
 ### Utility Functions
-import pandas as pd
+import array
+import collections
+import collections.abc
+import contextlib
+import datetime
+import functools
+import hashlib
+import heapq
+import importlib
+import itertools
+import json
+import locale
+import mmap
+import operator
+import os
+import pickle
+import queue
+import random
+import re
 import sqlite3
+import struct
+import threading
+import time
+import types
 from sqlite3 import Error
 
+class LazyModule:
+    # A module that is imported the first time one of its attributes is used, so loads
+    # and SQL queries run from the command line never pay for importing pandas, numpy or
+    # asyncio. Submodules (concurrent.futures, urllib.request) are imported the same way.
+
+    def __init__(self, name):
+        self._name = name
+
+    def __getattr__(self, attribute):
+        module = importlib.import_module(self._name)
+        try:
+            value = getattr(module, attribute)
+        except AttributeError:
+            value = importlib.import_module('%s.%s' % (self._name, attribute))
+        setattr(self, attribute, value)
+        return value
+
+pd = LazyModule('pandas')
+np = LazyModule('numpy')
+asyncio = LazyModule('asyncio')
+concurrent = LazyModule('concurrent')
+inspect = LazyModule('inspect')
+urllib = LazyModule('urllib')
+
 def create_connection(db_file, delete_db=False):
     import os
     if delete_db and os.path.exists(db_file):
         os.remove(db_file)
+        invalidate_lookups(db_file)
 
     conn = None
     try:
@@ -18,6 +65,21 @@ def create_connection(db_file, delete_db=False):
     return conn
 
 
+@contextlib.contextmanager
+def connection_for(db_file, conn=None):
+    # Yields conn when the caller already holds a connection, otherwise opens one
+    # to db_file for the duration of the block and closes it afterwards.
+    if conn is not None:
+        yield conn
+        return
+    conn = create_connection(db_file)
+    try:
+        yield conn
+    finally:
+        if conn is not None:
+            conn.close()
+
+
 def create_table(conn, create_table_sql, drop_table_name=None):
     
     if drop_table_name: # You can optionally pass drop_table_name to drop the table. 
@@ -41,289 +103,1923 @@ def execute_sql_statement(sql_statement, conn):
 
     return rows
 
-def step1_create_region_table(data_filename, normalized_database_filename):
-    # Inputs: Name of the data and normalized database filename
-    # Output: None
-    
-    ### BEGIN SOLUTION
-    conn = create_connection(normalized_database_filename)
-    sql = '''CREATE TABLE Region (
+def insert_in_chunks(conn, sql_statement, rows, chunk_size=100000):
+    # Runs executemany over any iterable of rows, chunk_size rows at a time,
+    # so generators can be loaded without materializing them. Returns the row count.
+    rows = iter(rows)
+    cur = conn.cursor()
+    count = 0
+    chunk = list(itertools.islice(rows, chunk_size))
+    while chunk:
+        cur.executemany(sql_statement, chunk)
+        count += len(chunk)
+        chunk = list(itertools.islice(rows, chunk_size))
+    return count
+
+# Instrumentation. Steps, loads and queries wrap their phases in trace('<step>.<phase>'),
+# which costs nothing until a Tracer is installed with tracing(). The tracer then keeps
+# one record per phase with its wall time, the counts the phase fills in (rows_read,
+# rows_inserted, bytes_read) and, with trace_memory=True, the peak of Python allocations
+# while it ran.
+TRACE_COUNTERS = ('rows_read', 'rows_inserted', 'bytes_read')
+
+class Tracer:
+
+    def __init__(self, trace_memory=False):
+        self.trace_memory = trace_memory
+        self.records = []
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._started_tracemalloc = False
+
+    @contextlib.contextmanager
+    def span(self, name, **counts):
+        import tracemalloc
+        stack = self._local.__dict__.setdefault('stack', [])
+        record = {'name': name, 'start': time.time()}
+        record.update(counts)
+        if self.trace_memory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                self._started_tracemalloc = True
+            peak = tracemalloc.get_traced_memory()[1]
+            for outer in stack:
+                outer['peak_bytes'] = max(outer.get('peak_bytes', 0), peak)
+            tracemalloc.reset_peak()
+        stack.append(record)
+        start = time.perf_counter()
+        try:
+            yield record
+        finally:
+            record['seconds'] = time.perf_counter() - start
+            stack.pop()
+            if self.trace_memory:
+                peak = max(record.get('peak_bytes', 0), tracemalloc.get_traced_memory()[1])
+                record['peak_bytes'] = peak
+                for outer in stack:
+                    outer['peak_bytes'] = max(outer.get('peak_bytes', 0), peak)
+                tracemalloc.reset_peak()
+            with self._lock:
+                self.records.append(record)
+
+    def close(self):
+        # Stops tracemalloc if this tracer started it, since tracing every allocation
+        # slows the whole process down. The records are kept.
+        if self._started_tracemalloc:
+            import tracemalloc
+            tracemalloc.stop()
+            self._started_tracemalloc = False
+
+    def json_lines(self):
+        # One JSON object per record, for structured logs.
+        with self._lock:
+            return ''.join(json.dumps(record, sort_keys=True) + '\n' for record in self.records)
+
+    def prometheus_text(self, prefix='mini_project2'):
+        # Totals per phase in the Prometheus text exposition format.
+        totals = collections.OrderedDict()
+        with self._lock:
+            for record in self.records:
+                step, _, phase = record['name'].partition('.')
+                total = totals.setdefault((step, phase or 'total'), collections.Counter())
+                total['calls'] += 1
+                total['seconds'] += record['seconds']
+                for counter in TRACE_COUNTERS:
+                    total[counter] += record.get(counter, 0)
+                total['peak_bytes'] = max(total['peak_bytes'], record.get('peak_bytes', 0))
+        metrics = [('calls_total', 'calls', 'counter', 'Times the phase ran.'),
+                   ('seconds_total', 'seconds', 'counter', 'Wall time spent in the phase.'),
+                   ('rows_read_total', 'rows_read', 'counter', 'Rows read by the phase.'),
+                   ('rows_inserted_total', 'rows_inserted', 'counter', 'Rows inserted by the phase.'),
+                   ('bytes_read_total', 'bytes_read', 'counter', 'Bytes of input read by the phase.')]
+        if self.trace_memory:
+            metrics.append(('peak_bytes', 'peak_bytes', 'gauge', 'Largest peak of Python allocations in the phase.'))
+        lines = []
+        for metric, key, kind, help_text in metrics:
+            lines.append('# HELP %s_phase_%s %s' % (prefix, metric, help_text))
+            lines.append('# TYPE %s_phase_%s %s' % (prefix, metric, kind))
+            for (step, phase), total in totals.items():
+                lines.append('%s_phase_%s{step="%s",phase="%s"} %s' % (prefix, metric, step, phase, total[key]))
+        return '\n'.join(lines) + '\n'
+
+_tracer = None
+
+@contextlib.contextmanager
+def tracing(tracer=None):
+    # Installs tracer (a new Tracer by default) for the duration of the block and yields it.
+    # On the way out the tracer is closed, which stops tracemalloc if it started it.
+    global _tracer
+    previous, _tracer = _tracer, tracer or Tracer()
+    try:
+        yield _tracer
+    finally:
+        _tracer.close()
+        _tracer = previous
+
+@contextlib.contextmanager
+def trace(name, **counts):
+    # Yields the record of phase `name` under the installed tracer, or a throwaway dict.
+    tracer = _tracer
+    if tracer is None:
+        yield dict(counts)
+        return
+    with tracer.span(name, **counts) as record:
+        yield record
+
+@contextlib.contextmanager
+def traced_transaction(conn, name):
+    # `with conn:` that traces the statements run in the block as <name>.insert and the
+    # commit on the way out as <name>.commit.
+    with trace(name + '.insert') as record:
+        try:
+            yield record
+        except BaseException:
+            conn.rollback()
+            raise
+    with trace(name + '.commit'):
+        conn.commit()
+
+# Settings applied while bulk loading. Journaling and fsyncs are off and foreign keys are
+# only validated once at the end, so a crash mid-load leaves a database to rebuild.
+# temp_store = MEMORY also keeps normalize()'s staging table in RAM; drop it for extracts
+# whose order lines do not fit in memory.
+BULK_LOAD_PRAGMAS = {
+    'journal_mode': 'OFF',
+    'synchronous': 'OFF',
+    'cache_size': -262144,
+    'temp_store': 'MEMORY',
+    'foreign_keys': 0,
+}
+
+@contextlib.contextmanager
+def bulk_load_settings(conn):
+    # Applies BULK_LOAD_PRAGMAS for the duration of the block, runs a single
+    # foreign_key_check over the loaded tables and restores the previous settings.
+    saved = {pragma: conn.execute('PRAGMA %s' % pragma).fetchone()[0] for pragma in BULK_LOAD_PRAGMAS}
+    for pragma, value in BULK_LOAD_PRAGMAS.items():
+        conn.execute('PRAGMA %s = %s' % (pragma, value))
+    try:
+        yield conn
+        violations = execute_sql_statement('PRAGMA foreign_key_check', conn)
+    finally:
+        for pragma, value in saved.items():
+            conn.execute('PRAGMA %s = %s' % (pragma, value))
+    if violations:
+        raise sqlite3.IntegrityError('%d rows violate a foreign key, first: %r' % (len(violations), violations[0]))
+
+def enable_wal(normalized_database_filename, conn=None):
+    # Switches the database to WAL journaling, so readers such as AsyncAnalytics never wait
+    # on a load. The journal mode is stored in the file and holds for every later
+    # connection, so this belongs to the build. Returns the journal mode now in effect.
+    with connection_for(normalized_database_filename, conn) as conn:
+        return conn.execute('PRAGMA journal_mode = WAL').fetchone()[0]
+
+# name -> id maps returned by the step2/4/6/8/10 dictionary helpers, memoized per database
+# file together with the DataVersion they were read at. A table's entry is dropped whenever
+# its stepN_create_*_table rewrites it and is read again when the version changes, and at
+# most LOOKUP_CACHE_SIZE databases are kept, least recently used first out.
+LOOKUP_CACHE_SIZE = 8
+_lookup_cache = collections.OrderedDict()
+_lookup_cache_lock = threading.Lock()
+
+def database_key(normalized_database_filename, conn=None):
+    # Resolved path of the main database, or None for in-memory databases that cannot be shared.
+    if conn is not None:
+        for seq, name, path in conn.execute('PRAGMA database_list'):
+            if name == 'main':
+                return os.path.realpath(path) if path else None
+    if normalized_database_filename in (None, '', ':memory:'):
+        return None
+    return os.path.realpath(normalized_database_filename)
+
+# Lookups with at least COMPACT_LOOKUP_ROWS names are kept as a NameIndex instead of a
+# dict. persist_lookups() saves the Customer and Product lookups next to the database,
+# and later processes memory-map those files instead of querying the tables again.
+COMPACT_LOOKUP_ROWS = 1000000
+
+class NameIndex(collections.abc.Mapping):
+    # Read-only name -> id map in three flat buffers: the UTF-8 names sorted and
+    # concatenated, the offset where each name starts (plus the end), and the ids in the
+    # same order. Lookups binary search the names. Per name this costs the UTF-8 bytes
+    # plus 16 bytes, against roughly 100 bytes of str, int and hash table entry in a dict,
+    # at the price of a few microseconds per lookup instead of a hash probe.
+    MAGIC = b'NAMEIDX1'
+    HEADER = struct.Struct('<8sqq16s')
+
+    def __init__(self, names, offsets, ids, version=None):
+        self._names = names
+        self._offsets = offsets
+        self._ids = ids
+        self.version = version
+
+    @classmethod
+    def from_sorted_rows(cls, rows, version=None):
+        # rows are (name, id) sorted by the names' UTF-8 bytes; the last id of a repeated
+        # name wins, as it would in dict(rows).
+        names = bytearray()
+        offsets = array.array('q', [0])
+        ids = array.array('q')
+        previous = None
+        for name, id_ in rows:
+            encoded = name.encode('utf-8')
+            if encoded == previous:
+                ids[-1] = id_
+                continue
+            names += encoded
+            offsets.append(len(names))
+            ids.append(id_)
+            previous = encoded
+        return cls(names, offsets, ids, version)
+
+    @classmethod
+    def from_mapping(cls, mapping, version=None):
+        return cls.from_sorted_rows(sorted(mapping.items(), key=lambda item: item[0].encode('utf-8')), version)
+
+    @classmethod
+    def open(cls, path):
+        # Memory-maps an index written by save(); nothing is read until it is used.
+        with open(path, 'rb') as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, count, names_size, version = cls.HEADER.unpack_from(mm)
+        if magic != cls.MAGIC:
+            mm.close()
+            raise ValueError('%s is not a NameIndex file' % path)
+        view = memoryview(mm)
+        start = cls.HEADER.size
+        offsets = view[start:start + 8 * (count + 1)].cast('q')
+        start += 8 * (count + 1)
+        ids = view[start:start + 8 * count].cast('q')
+        start += 8 * count
+        return cls(NameBuffer(mm, start), offsets, ids, version.rstrip(b'\0').decode('ascii') or None)
+
+    def save(self, path):
+        version = (self.version or '').encode('ascii')
+        with open(path + '.tmp', 'wb') as f:
+            f.write(self.HEADER.pack(self.MAGIC, len(self._ids), self._offsets[-1], version))
+            f.write(memoryview(self._offsets).cast('B'))
+            f.write(memoryview(self._ids).cast('B'))
+            f.write(self._names[0:self._offsets[-1]])
+        os.replace(path + '.tmp', path)
+
+    def __reduce__(self):
+        # Memory-mapped buffers cannot be pickled, so worker processes get a copy.
+        return (NameIndex, (bytes(self._names[0:self._offsets[-1]]), array.array('q', self._offsets),
+                            array.array('q', self._ids), self.version))
+
+    def _find(self, name):
+        key = name.encode('utf-8')
+        names, offsets = self._names, self._offsets
+        lo, hi = 0, len(self._ids)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if names[offsets[mid]:offsets[mid + 1]] < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < len(self._ids) and names[offsets[lo]:offsets[lo + 1]] == key:
+            return lo
+        return -1
+
+    def __getitem__(self, name):
+        position = self._find(name) if isinstance(name, str) else -1
+        if position < 0:
+            raise KeyError(name)
+        return self._ids[position]
+
+    def __contains__(self, name):
+        return isinstance(name, str) and self._find(name) >= 0
+
+    def __len__(self):
+        return len(self._ids)
+
+    def __iter__(self):
+        names, offsets = self._names, self._offsets
+        for position in range(len(self._ids)):
+            yield bytes(names[offsets[position]:offsets[position + 1]]).decode('utf-8')
+
+    def close(self):
+        # Unmaps an index opened with open(); it cannot be used afterwards.
+        if isinstance(self._names, NameBuffer):
+            self._offsets.release()
+            self._ids.release()
+            self._names._mm.close()
+
+    def nbytes(self):
+        # Size of the three buffers.
+        return self._offsets[-1] + 8 * (len(self._offsets) + len(self._ids))
+
+class NameBuffer:
+    # The names of a memory-mapped NameIndex; slices are relative to where they start in the file.
+    def __init__(self, mm, start):
+        self._mm = mm
+        self._start = start
+
+    def __getitem__(self, item):
+        return self._mm[self._start + item.start:self._start + item.stop]
+
+def lookup_index_path(normalized_database_filename, table):
+    return '%s.%s.names' % (normalized_database_filename, table)
+
+def load_lookup(normalized_database_filename, table, sql, conn):
+    # A persisted NameIndex for the current data version, a NameIndex for large tables, or a
+    # read-only view of a dict. The maps are cached and shared, so callers cannot change them.
+    version = data_version(conn)
+    key = database_key(normalized_database_filename, conn)
+    if key is not None and version is not None and os.path.exists(lookup_index_path(key, table)):
+        index = NameIndex.open(lookup_index_path(key, table))
+        if index.version == version:
+            return index
+        index.close()
+    sql = sql.strip().rstrip(';')
+    if execute_sql_statement('SELECT COUNT(*) FROM (%s)' % sql, conn)[0][0] < COMPACT_LOOKUP_ROWS:
+        return types.MappingProxyType(dict(conn.execute(sql)))
+    # SQLite's default BINARY collation orders text by its UTF-8 bytes
+    return NameIndex.from_sorted_rows(conn.execute('SELECT * FROM (%s) ORDER BY 1, 2' % sql), version)
+
+def persist_lookups(normalized_database_filename, conn=None):
+    # Saves the Customer and Product lookups as NameIndex files next to the database, tagged
+    # with its data version, and returns their paths. Any load changes the version, after
+    # which the files are ignored until they are persisted again.
+    paths = []
+    with connection_for(normalized_database_filename, conn) as conn:
+        key = database_key(normalized_database_filename, conn)
+        if key is None:
+            raise ValueError('Lookups of an in-memory database cannot be persisted')
+        version = data_version(conn)
+        for table, lookup in (('Customer', step6_create_customer_to_customerid_dictionary),
+                              ('Product', step10_create_product_to_productid_dictionary)):
+            index = lookup(normalized_database_filename, conn=conn)
+            if isinstance(index, NameIndex):
+                # tagged with the version it was read at, which later loads may have bumped
+                index = NameIndex(index._names, index._offsets, index._ids, version)
+            else:
+                index = NameIndex.from_mapping(index, version)
+            index.save(lookup_index_path(key, table))
+            paths.append(lookup_index_path(key, table))
+    return paths
+
+def cached_lookup(normalized_database_filename, table, sql, conn=None):
+    # Maps are cached with the DataVersion they were read at and read again once it
+    # changes, so loads made by another process are picked up as well.
+    with connection_for(normalized_database_filename, conn) as conn:
+        key = database_key(normalized_database_filename, conn)
+        version = data_version(conn)
+        if key is not None:
+            with _lookup_cache_lock:
+                cached = _lookup_cache.get(key, {}).get(table)
+                if cached is not None and cached[0] == version:
+                    _lookup_cache.move_to_end(key)
+                    return cached[1]
+        with trace('lookup.%s' % table) as record:
+            lookup = load_lookup(normalized_database_filename, table, sql, conn)
+            record['rows_read'] = len(lookup)
+    if key is not None:
+        with _lookup_cache_lock:
+            _lookup_cache.setdefault(key, {})[table] = (version, lookup)
+            _lookup_cache.move_to_end(key)
+            while len(_lookup_cache) > LOOKUP_CACHE_SIZE:
+                _lookup_cache.popitem(last=False)
+    return lookup
+
+def invalidate_lookups(normalized_database_filename, table=None, conn=None):
+    # Drops the cached map for table, or every cached map of the database when table is None,
+    # together with the persisted NameIndex files they would be read back from.
+    key = database_key(normalized_database_filename, conn)
+    with _lookup_cache_lock:
+        if table is None:
+            _lookup_cache.pop(key, None)
+            _analytics_cache.pop(key, None)
+        else:
+            _lookup_cache.get(key, {}).pop(table, None)
+    if key is not None:
+        for name in ('Customer', 'Product') if table is None else (table,):
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(lookup_index_path(key, name))
+
+REGION_TABLE_SQL = '''CREATE TABLE Region (
                 RegionID INTEGER NOT NULL PRIMARY KEY, 
                 Region TEXT NOT NULL);'''
-    create_table(conn, sql)
-    def insert_values(conn, values):
-        sql = ''' INSERT INTO Region (Region) VALUES(?) '''
-        cur = conn.cursor()
-        cur.executemany(sql, values)
-        return cur.lastrowid
-    with open(data_filename, 'r') as file:
-        data = []
-        for line in file:
-            data.append(line.strip().split('\t')[4])
-        data = list(set(data[1:]))
-        data.sort()
-        data = [(ele,) for ele in data]
+
+REGION_INSERT_SQL = 'INSERT INTO Region (Region) VALUES (?)'
+
+COUNTRY_TABLE_SQL = '''CREATE TABLE Country (
+                CountryID INTEGER NOT NULL PRIMARY KEY, 
+                Country TEXT NOT NULL,
+                RegionID INTEGER NOT NULL, 
+                FOREIGN KEY (RegionID) REFERENCES Region(RegionID));'''
+
+COUNTRY_INSERT_SQL = 'INSERT INTO Country (Country, RegionID) VALUES (?, ?)'
+
+CUSTOMER_TABLE_SQL = '''CREATE TABLE Customer (
+                    CustomerID INTEGER NOT NULL PRIMARY KEY, 
+                    FirstName TEXT NOT NULL,
+                    LastName TEXT NOT NULL,
+                    Address TEXT NOT NULL,
+                    City TEXT NOT NULL,
+                    CountryID INTEGER NOT NULL, 
+                    FOREIGN KEY (CountryID) REFERENCES Country (CountryID));'''
+
+CUSTOMER_INSERT_SQL = 'INSERT INTO Customer (FirstName, LastName, Address, City, CountryID) VALUES (?, ?, ?, ?, ?)'
+
+PRODUCTCATEGORY_TABLE_SQL = '''CREATE TABLE ProductCategory (
+                    ProductCategoryID integer not null Primary Key,
+                    ProductCategory Text not null,
+                    ProductCategoryDescription Text not null);'''
+
+PRODUCTCATEGORY_INSERT_SQL = 'INSERT INTO ProductCategory (ProductCategory, ProductCategoryDescription) VALUES (?, ?)'
+
+PRODUCT_TABLE_SQL = '''CREATE TABLE Product (
+                    ProductID integer not null Primary key,
+                    ProductName Text not null,
+                    ProductUnitPrice Real not null,
+                    ProductCategoryID integer not null,
+                    foreign key (ProductCategoryID) REFERENCES ProductCategory (ProductCategoryID));'''
+
+PRODUCT_INSERT_SQL = 'INSERT INTO Product (ProductName, ProductUnitPrice, ProductCategoryID) VALUES (?, ?, ?)'
+
+ORDERDETAIL_TABLE_SQL = '''create table if not exists OrderDetail (
+            OrderID integer primary key not null, 
+            CustomerID inetger not null, 
+            ProductID integer not null, 
+            OrderDate integer not null, 
+            DateKey integer not null, 
+            QuantityOrdered integer not null, 
+            foreign key(CustomerID) references Customer(CustomerID), 
+            foreign key(ProductID) references Product(ProductID));'''
+
+ORDERDETAIL_INSERT_SQL = 'INSERT INTO OrderDetail (CustomerID, ProductID, OrderDate, DateKey, QuantityOrdered) VALUES (?, ?, ?, ?, ?)'
+
+# Secondary indexes, created by each step once its table is loaded. The dimension
+# indexes enforce the natural keys; the OrderDetail ones serve the customer filters
+# of ex1/ex2, the per-customer date ordering of ex11 and the date buckets of ex8 - ex10.
+TABLE_INDEX_SQL = {
+    'Region': ['CREATE UNIQUE INDEX IF NOT EXISTS RegionName ON Region (Region);'],
+    'Country': ['CREATE UNIQUE INDEX IF NOT EXISTS CountryName ON Country (Country);'],
+    'Customer': [],
+    'ProductCategory': ['CREATE UNIQUE INDEX IF NOT EXISTS ProductCategoryName ON ProductCategory (ProductCategory);'],
+    'Product': ['CREATE UNIQUE INDEX IF NOT EXISTS ProductName ON Product (ProductName);'],
+    'OrderDetail': ['CREATE INDEX IF NOT EXISTS OrderDetailCustomerDate ON OrderDetail (CustomerID, OrderDate);',
+                    'CREATE INDEX IF NOT EXISTS OrderDetailProduct ON OrderDetail (ProductID);',
+                    'CREATE INDEX IF NOT EXISTS OrderDetailDate ON OrderDetail (DateKey);'],
+}
+
+def create_indexes(conn, table):
+    for sql in TABLE_INDEX_SQL[table]:
+        try:
+            conn.execute(sql)
+        except Error as e:
+            print(e)
+
+# One row per distinct order date. OrderDetail.DateKey holds the date as a YYYYMMDD
+# integer, and the quarterly and monthly rollups of ex8 - ex10 join here instead of
+# parsing OrderDate text with strftime on every row.
+CALENDAR_TABLE_SQL = '''create table if not exists Calendar (
+            DateKey integer primary key not null,
+            OrderDate text not null,
+            Year integer not null,
+            Quarter text not null,
+            Month integer not null,
+            MonthName text not null,
+            Day integer not null);'''
+
+MONTH_NAMES = ['January', 'February', 'March', 'April', 'May', 'June', 'July',
+               'August', 'September', 'October', 'November', 'December']
+
+def refresh_calendar(conn):
+    # Adds the Calendar rows for any DateKey in OrderDetail that is not there yet.
+    create_table(conn, CALENDAR_TABLE_SQL)
+    sql = 'SELECT DISTINCT DateKey FROM OrderDetail WHERE DateKey NOT IN (SELECT DateKey FROM Calendar)'
+    rows = []
+    for (date_key,) in execute_sql_statement(sql, conn):
+        year, month, day = date_key // 10000, date_key // 100 % 100, date_key % 100
+        rows.append((date_key, '%04d-%02d-%02d' % (year, month, day), year,
+                     'Q%d' % ((month - 1) // 3 + 1), month, MONTH_NAMES[month - 1], day))
+    with conn:
+        conn.executemany('INSERT INTO Calendar (DateKey, OrderDate, Year, Quarter, Month, MonthName, Day) VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+
+# Order totals per customer, country and region, materialized for ex3 - ex7.
+# refresh_totals() folds in the OrderDetail rows past the OrderID recorded in
+# TotalsRefresh, so the call at the end of a build aggregates every order and
+# later calls only the rows appended since.
+TOTALS_TABLE_SQL = [
+    '''create table if not exists CustomerTotal (
+            CustomerID integer primary key not null,
+            Total real not null,
+            foreign key(CustomerID) references Customer(CustomerID));''',
+    '''create table if not exists CountryTotal (
+            CountryID integer primary key not null,
+            Total real not null,
+            foreign key(CountryID) references Country(CountryID));''',
+    '''create table if not exists RegionTotal (
+            RegionID integer primary key not null,
+            Total real not null,
+            foreign key(RegionID) references Region(RegionID));''',
+    '''create table if not exists TotalsRefresh (
+            LastOrderID integer not null);''',
+]
+
+TOTALS_REFRESH_SQL = [
+    """INSERT INTO CustomerTotal (CustomerID, Total)
+    SELECT o.CustomerID, SUM(p.ProductUnitPrice * o.QuantityOrdered)
+    FROM OrderDetail o
+    JOIN Product p on o.ProductID = p.ProductID
+    WHERE o.OrderID > :LastOrderID AND o.OrderID <= :NewLastOrderID
+    GROUP BY o.CustomerID
+    ON CONFLICT (CustomerID) DO UPDATE SET Total = Total + excluded.Total""",
+    """INSERT INTO CountryTotal (CountryID, Total)
+    SELECT c.CountryID, SUM(p.ProductUnitPrice * o.QuantityOrdered)
+    FROM OrderDetail o
+    JOIN Customer c ON o.CustomerID = c.CustomerID
+    JOIN Product p on o.ProductID = p.ProductID
+    WHERE o.OrderID > :LastOrderID AND o.OrderID <= :NewLastOrderID
+    GROUP BY c.CountryID
+    ON CONFLICT (CountryID) DO UPDATE SET Total = Total + excluded.Total""",
+    """INSERT INTO RegionTotal (RegionID, Total)
+    SELECT ct.RegionID, SUM(p.ProductUnitPrice * o.QuantityOrdered)
+    FROM OrderDetail o
+    JOIN Customer c ON o.CustomerID = c.CustomerID
+    JOIN Product p on o.ProductID = p.ProductID
+    JOIN Country ct on c.CountryID = ct.CountryID
+    WHERE o.OrderID > :LastOrderID AND o.OrderID <= :NewLastOrderID
+    GROUP BY ct.RegionID
+    ON CONFLICT (RegionID) DO UPDATE SET Total = Total + excluded.Total""",
+]
+
+def refresh_totals(conn):
+    for sql in TOTALS_TABLE_SQL:
+        create_table(conn, sql)
+    last_order_id = execute_sql_statement('SELECT MAX(LastOrderID) FROM TotalsRefresh', conn)[0][0] or 0
+    new_last_order_id = execute_sql_statement('SELECT MAX(OrderID) FROM OrderDetail', conn)[0][0] or 0
+    if new_last_order_id <= last_order_id:
+        return
+    params = {'LastOrderID': last_order_id, 'NewLastOrderID': new_last_order_id}
     with conn:
-        insert_values(conn, data)
+        for sql in TOTALS_REFRESH_SQL:
+            conn.execute(sql, params)
+        conn.execute('DELETE FROM TotalsRefresh')
+        conn.execute('INSERT INTO TotalsRefresh (LastOrderID) VALUES (?)', (new_last_order_id,))
+
+# Longest gap between consecutive order dates per customer, materialized for ex11.
+# refresh_customer_gaps() recomputes every customer with OrderDetail rows past the
+# OrderID recorded in GapsRefresh, reading its orders in (CustomerID, OrderDate) index
+# order, so the call at the end of a build covers every customer and later calls only
+# the customers an append touched.
+CUSTOMER_GAP_TABLE_SQL = [
+    '''create table if not exists CustomerGap (
+            CustomerID integer primary key not null,
+            PreviousOrderDate text,
+            OrderDate text not null,
+            MaxDaysWithoutOrder real,
+            foreign key(CustomerID) references Customer(CustomerID));''',
+    '''create table if not exists GapsRefresh (
+            LastOrderID integer not null);''',
+]
+
+def customer_gaps(rows):
+    # rows are (CustomerID, OrderDate) sorted by both. Yields one
+    # (CustomerID, PreviousOrderDate, OrderDate, MaxDaysWithoutOrder) per customer, where
+    # the two dates bound the first of its longest gaps. A customer with a single order
+    # line has no gap and gets (CustomerID, None, OrderDate, None).
+    ordinals = {}
+
+    def day(order_date):
+        ordinal = ordinals.get(order_date)
+        if ordinal is None:
+            ordinal = ordinals[order_date] = datetime.date.fromisoformat(order_date).toordinal()
+        return ordinal
+
+    for customer_id, orders in itertools.groupby(rows, operator.itemgetter(0)):
+        previous = next(orders)[1]
+        gap = None
+        for _, order_date in orders:
+            days = day(order_date) - day(previous)
+            if gap is None or days > gap[2]:
+                gap = (previous, order_date, days)
+            previous = order_date
+        if gap is None:
+            yield (customer_id, None, previous, None)
+        else:
+            yield (customer_id, gap[0], gap[1], float(gap[2]))
+
+def refresh_customer_gaps(conn):
+    for sql in CUSTOMER_GAP_TABLE_SQL:
+        create_table(conn, sql)
+    last_order_id = execute_sql_statement('SELECT MAX(LastOrderID) FROM GapsRefresh', conn)[0][0] or 0
+    new_last_order_id = execute_sql_statement('SELECT MAX(OrderID) FROM OrderDetail', conn)[0][0] or 0
+    if new_last_order_id <= last_order_id:
+        return
+    if last_order_id:
+        customer_ids = [row[0] for row in conn.execute('SELECT DISTINCT CustomerID FROM OrderDetail WHERE OrderID > ? AND OrderID <= ?',
+                                                       (last_order_id, new_last_order_id))]
+        sql = '''SELECT CustomerID, OrderDate FROM OrderDetail
+            WHERE CustomerID IN (SELECT value FROM json_each(?)) ORDER BY CustomerID, OrderDate'''
+        params = (json.dumps(customer_ids),)
+    else:
+        sql = 'SELECT CustomerID, OrderDate FROM OrderDetail ORDER BY CustomerID, OrderDate'
+        params = ()
+    with conn:
+        rows = conn.cursor().execute(sql, params)
+        conn.executemany('INSERT OR REPLACE INTO CustomerGap (CustomerID, PreviousOrderDate, OrderDate, MaxDaysWithoutOrder) VALUES (?, ?, ?, ?)',
+                         customer_gaps(rows))
+        conn.execute('DELETE FROM GapsRefresh')
+        conn.execute('INSERT INTO GapsRefresh (LastOrderID) VALUES (?)', (new_last_order_id,))
+
+
+# A random token replaced by every step or load that changes the tables, so a cached
+# query result is only reused while the data it was computed from is unchanged, also
+# across a delete_db rebuild of the same file.
+DATA_VERSION_TABLE_SQL = '''create table if not exists DataVersion (
+            Version text not null);'''
+
+def bump_data_version(conn):
+    create_table(conn, DATA_VERSION_TABLE_SQL)
+    with conn:
+        conn.execute('DELETE FROM DataVersion')
+        conn.execute('INSERT INTO DataVersion (Version) VALUES (?)', (os.urandom(8).hex(),))
+
+def data_version(conn):
+    # The current DataVersion token, or None for a database that has never been versioned.
+    try:
+        row = conn.execute('SELECT Version FROM DataVersion').fetchone()
+    except sqlite3.OperationalError:
+        return None
+    return row[0] if row else None
+
+# Every load that fills OrderDetail records a LoadFile row and the checksum of each
+# data line it read, so append() can skip the lines a database already holds.
+LOAD_MANIFEST_TABLE_SQL = [
+    '''create table if not exists LoadFile (
+            LoadID integer primary key not null,
+            FileName text not null,
+            LoadedAt text not null,
+            LineCount integer not null,
+            SkippedCount integer not null);''',
+    '''create table if not exists LoadManifest (
+            LineChecksum blob primary key not null,
+            LoadID integer not null,
+            foreign key(LoadID) references LoadFile(LoadID)) without rowid;''',
+]
+
+def line_checksum(line):
+    # line is a data line with the line ending stripped
+    return hashlib.blake2b(line.encode('utf-8'), digest_size=16).digest()
+
+class LoadManifestWriter:
+    # Records a load of data_filename in the current transaction. The LoadFile row goes
+    # in first, line checksums are written to LoadManifest chunk_size at a time as they
+    # are added, and close() sets the final LineCount, so a load holds at most one chunk
+    # of checksums in memory.
+
+    def __init__(self, conn, data_filename, skipped_count=0, chunk_size=100000):
+        for sql in LOAD_MANIFEST_TABLE_SQL:
+            conn.execute(sql)
+        self.conn = conn
+        self.chunk_size = chunk_size
+        self.line_count = 0
+        self.load_id = conn.execute('INSERT INTO LoadFile (FileName, LoadedAt, LineCount, SkippedCount) VALUES (?, ?, ?, ?)',
+                                    (os.path.abspath(data_filename), datetime.datetime.now().isoformat(timespec='seconds'),
+                                     0, skipped_count)).lastrowid
+        self._pending = []
+
+    def add(self, checksum):
+        self._pending.append(checksum)
+        if len(self._pending) >= self.chunk_size:
+            self.flush()
+
+    def extend(self, checksums):
+        for checksum in checksums:
+            self.add(checksum)
+
+    def flush(self):
+        self.conn.executemany('INSERT OR IGNORE INTO LoadManifest (LineChecksum, LoadID) VALUES (?, ?)',
+                              ((checksum, self.load_id) for checksum in self._pending))
+        self.line_count += len(self._pending)
+        self._pending = []
+
+    def close(self):
+        self.flush()
+        self.conn.execute('UPDATE LoadFile SET LineCount = ? WHERE LoadID = ?', (self.line_count, self.load_id))
+        return self.load_id
+
+def record_load(conn, data_filename, checksums, skipped_count=0):
+    # Records a load of data_filename and all of its line checksums in the current transaction.
+    manifest = LoadManifestWriter(conn, data_filename, skipped_count)
+    manifest.extend(checksums)
+    return manifest.close()
+
+def read_columns(data_filename, columns):
+    # Yields a tuple of the given columns for every data line. The file is memory-mapped
+    # and read line by line without the text-mode buffering copies, and each line is only
+    # split up to the last requested column, so step1 does not build eleven strings per
+    # line to keep one. Blank lines are skipped.
+    encoding = locale.getpreferredencoding(False)
+    maxsplit = max(columns) + 1
+    pick = operator.itemgetter(*columns)
+    if len(columns) == 1:
+        pick = lambda fields, column=columns[0]: (fields[column],)
+    with open(data_filename, 'rb') as f:
+        if not os.fstat(f.fileno()).st_size:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            mm.readline()
+            for line in iter(mm.readline, b''):
+                line = line.strip()
+                if line:
+                    yield pick(line.decode(encoding).split('\t', maxsplit))
+
+def step1_create_region_table(data_filename, normalized_database_filename, conn=None):
+    # Inputs: Name of the data and normalized database filename
+    # Output: None
     
+    ### BEGIN SOLUTION
+    with connection_for(normalized_database_filename, conn) as conn:
+        sql = REGION_TABLE_SQL
+        create_table(conn, sql)
+        def insert_values(conn, values):
+            sql = REGION_INSERT_SQL
+            cur = conn.cursor()
+            cur.executemany(sql, values)
+            return cur.lastrowid
+        with trace('step1.parse', bytes_read=os.path.getsize(data_filename)) as record:
+            data = []
+            for fields in read_columns(data_filename, (4,)):
+                data.append(fields[0])
+            record['rows_read'] = len(data)
+        with trace('step1.build'):
+            data = list(set(data))
+            data.sort()
+            data = [(ele,) for ele in data]
+        with traced_transaction(conn, 'step1') as record:
+            insert_values(conn, data)
+            record['rows_inserted'] = len(data)
+        invalidate_lookups(normalized_database_filename, 'Region', conn)
+        with trace('step1.index'):
+            create_indexes(conn, 'Region')
+        bump_data_version(conn)
+
     ### END SOLUTION
 
-def step2_create_region_to_regionid_dictionary(normalized_database_filename):
+def step2_create_region_to_regionid_dictionary(normalized_database_filename, conn=None):
     
     
     ### BEGIN SOLUTION
-    conn = create_connection(normalized_database_filename)
     sql = 'SELECT DISTINCT(Region), RegionID FROM Region'
-    regions = execute_sql_statement(sql, conn)
-    return dict(regions)
+    return cached_lookup(normalized_database_filename, 'Region', sql, conn)
 
     ### END SOLUTION
 
 
-def step3_create_country_table(data_filename, normalized_database_filename):
+def step3_create_country_table(data_filename, normalized_database_filename, conn=None):
     # Inputs: Name of the data and normalized database filename
     # Output: None
     
     ### BEGIN SOLUTION
-    conn = create_connection(normalized_database_filename)
-    sql = '''CREATE TABLE Country (
-                CountryID INTEGER NOT NULL PRIMARY KEY, 
-                Country TEXT NOT NULL,
-                RegionID INTEGER NOT NULL, 
-                FOREIGN KEY (RegionID) REFERENCES Region(RegionID));'''
-    create_table(conn, sql)
-    def insert_values(conn, values):
-        sql = ''' INSERT INTO Country (Country, RegionID) VALUES(?, ?) '''
-        cur = conn.cursor()
-        cur.executemany(sql, values)
-        return cur.lastrowid
-    with open(data_filename, 'r') as file:
-        data = []
-        for line in file:
-            data.append(line.strip().split('\t')[3:5])
-        data = data[1:]
-        data.sort()
-        region_dict = step2_create_region_to_regionid_dictionary(normalized_database_filename)
-        country_region = {ele[0]: region_dict[ele[1]] for ele in data}
-        country_region = list(country_region.items())
-    with conn:
-        insert_values(conn, country_region)        
+    with connection_for(normalized_database_filename, conn) as conn:
+        sql = COUNTRY_TABLE_SQL
+        create_table(conn, sql)
+        def insert_values(conn, values):
+            sql = COUNTRY_INSERT_SQL
+            cur = conn.cursor()
+            cur.executemany(sql, values)
+            return cur.lastrowid
+        with trace('step3.parse', bytes_read=os.path.getsize(data_filename)) as record:
+            data = list(read_columns(data_filename, (3, 4)))
+            record['rows_read'] = len(data)
+        with trace('step3.build'):
+            data.sort()
+            region_dict = step2_create_region_to_regionid_dictionary(normalized_database_filename, conn=conn)
+            country_region = {ele[0]: region_dict[ele[1]] for ele in data}
+            country_region = list(country_region.items())
+        with traced_transaction(conn, 'step3') as record:
+            insert_values(conn, country_region)
+            record['rows_inserted'] = len(country_region)
+        invalidate_lookups(normalized_database_filename, 'Country', conn)
+        with trace('step3.index'):
+            create_indexes(conn, 'Country')
+        bump_data_version(conn)
     ### END SOLUTION
 
 
-def step4_create_country_to_countryid_dictionary(normalized_database_filename):
+def step4_create_country_to_countryid_dictionary(normalized_database_filename, conn=None):
     
     
     ### BEGIN SOLUTION
-    conn = create_connection(normalized_database_filename)
     sql = 'SELECT DISTINCT(Country), CountryID FROM Country'
-    countries = execute_sql_statement(sql, conn)
-    return dict(countries)
+    return cached_lookup(normalized_database_filename, 'Country', sql, conn)
     ### END SOLUTION
         
         
-def step5_create_customer_table(data_filename, normalized_database_filename):
+def step5_create_customer_table(data_filename, normalized_database_filename, conn=None):
 
     ### BEGIN SOLUTION  
-    conn = create_connection(normalized_database_filename)
-    sql = '''CREATE TABLE Customer (
-                    CustomerID INTEGER NOT NULL PRIMARY KEY, 
-                    FirstName TEXT NOT NULL,
-                    LastName TEXT NOT NULL,
-                    Address TEXT NOT NULL,
-                    City TEXT NOT NULL,
-                    CountryID INTEGER NOT NULL, 
-                    FOREIGN KEY (CountryID) REFERENCES Country (CountryID));'''
-    create_table(conn, sql)
-    def insert_values(conn, values):
-        sql = ''' INSERT INTO Customer (FirstName, LastName, Address, City, CountryID) VALUES(?, ?, ?, ?, ?);'''
-        cur = conn.cursor()
-        cur.executemany(sql, values)
-        return cur.lastrowid
-    with open(data_filename, 'r') as file:
-        data = []
-        for line in file:
-            data.append(line.strip().split('\t')[:4])
-        data = data[1:]
-        data.sort()
-        country_ids = step4_create_country_to_countryid_dictionary(normalized_database_filename)
-        data_pp = [ele[:3]+[country_ids[ele[3]]] for ele in data]
-        data_pp = [tuple(ele[0].split(' ',1)) + tuple(ele[1:]) for ele in data_pp]
-    with conn:
-        insert_values(conn, data_pp)
+    with connection_for(normalized_database_filename, conn) as conn:
+        sql = CUSTOMER_TABLE_SQL
+        create_table(conn, sql)
+        def insert_values(conn, values):
+            sql = CUSTOMER_INSERT_SQL
+            cur = conn.cursor()
+            cur.executemany(sql, values)
+            return cur.lastrowid
+        with trace('step5.parse', bytes_read=os.path.getsize(data_filename)) as record:
+            data = list(read_columns(data_filename, (0, 1, 2, 3)))
+            record['rows_read'] = len(data)
+        with trace('step5.build'):
+            data.sort()
+            country_ids = step4_create_country_to_countryid_dictionary(normalized_database_filename, conn=conn)
+            data_pp = [ele[:3]+(country_ids[ele[3]],) for ele in data]
+            data_pp = [tuple(ele[0].split(' ',1)) + tuple(ele[1:]) for ele in data_pp]
+        with traced_transaction(conn, 'step5') as record:
+            insert_values(conn, data_pp)
+            record['rows_inserted'] = len(data_pp)
+        invalidate_lookups(normalized_database_filename, 'Customer', conn)
+        with trace('step5.index'):
+            create_indexes(conn, 'Customer')
+        bump_data_version(conn)
     ### END SOLUTION
 
 
-def step6_create_customer_to_customerid_dictionary(normalized_database_filename):
+def step6_create_customer_to_customerid_dictionary(normalized_database_filename, conn=None):
     
     
     ### BEGIN SOLUTION
-    conn = create_connection(normalized_database_filename)
     sql = 'SELECT FirstName || " " || LastName, CustomerID FROM Customer;'
-    customers = execute_sql_statement(sql, conn)
-    return dict(customers)
+    return cached_lookup(normalized_database_filename, 'Customer', sql, conn)
     ### END SOLUTION
         
-def step7_create_productcategory_table(data_filename, normalized_database_filename):
+def step7_create_productcategory_table(data_filename, normalized_database_filename, conn=None):
     # Inputs: Name of the data and normalized database filename
     # Output: None
 
     
     ### BEGIN SOLUTION
-    conn = create_connection(normalized_database_filename)
-    sql = '''CREATE TABLE ProductCategory (
-                    ProductCategoryID integer not null Primary Key,
-                    ProductCategory Text not null,
-                    ProductCategoryDescription Text not null);'''
-    create_table(conn, sql)
-    def insert_values(conn, values):
-        sql = ''' INSERT INTO ProductCategory (ProductCategory, ProductCategoryDescription) VALUES(?, ?);'''
+    with connection_for(normalized_database_filename, conn) as conn:
+        sql = PRODUCTCATEGORY_TABLE_SQL
+        create_table(conn, sql)
+        def insert_values(conn, values):
+            sql = PRODUCTCATEGORY_INSERT_SQL
+            cur = conn.cursor()
+            cur.executemany(sql, values)
+            return cur.lastrowid
+        with trace('step7.parse', bytes_read=os.path.getsize(data_filename)) as record:
+            data = list(read_columns(data_filename, (6, 7)))
+            record['rows_read'] = len(data)
+        with trace('step7.build'):
+            data.sort()
+            data = [[ele[0].split(';'),ele[1].split(';')] for ele in data]
+            data = [dict(zip(ele[0],ele[1])) for ele in data]
+            product_dict = {}
+            for ele in data:
+                product_dict.update(ele)
+            product_values = list(product_dict.items())
+            product_values.sort()
+        with traced_transaction(conn, 'step7') as record:
+            insert_values(conn, product_values)
+            record['rows_inserted'] = len(product_values)
+        invalidate_lookups(normalized_database_filename, 'ProductCategory', conn)
+        with trace('step7.index'):
+            create_indexes(conn, 'ProductCategory')
+        bump_data_version(conn)
+
+    ### END SOLUTION
+
+def step8_create_productcategory_to_productcategoryid_dictionary(normalized_database_filename, conn=None):
+    
+    
+    ### BEGIN SOLUTION
+    sql = 'SELECT ProductCategory, ProductCategoryID FROM ProductCategory;'
+    return cached_lookup(normalized_database_filename, 'ProductCategory', sql, conn)
+
+    ### END SOLUTION
+        
+
+def step9_create_product_table(data_filename, normalized_database_filename, conn=None):
+    # Inputs: Name of the data and normalized database filename
+    # Output: None
+
+    
+    ### BEGIN SOLUTION
+    with connection_for(normalized_database_filename, conn) as conn:
+        sql = PRODUCT_TABLE_SQL
+        create_table(conn, sql)
+        def insert_values(conn, values):
+            sql = PRODUCT_INSERT_SQL
+            cur = conn.cursor()
+            cur.executemany(sql, values)
+            return cur.lastrowid
+        categories = step8_create_productcategory_to_productcategoryid_dictionary(normalized_database_filename, conn=conn)
+        with trace('step9.parse', bytes_read=os.path.getsize(data_filename)) as record:
+            data = list(read_columns(data_filename, (5, 6, 8)))
+            record['rows_read'] = len(data)
+        with trace('step9.build'):
+            data = [[ele[0].split(';'),ele[1].split(';'),ele[2].split(';')] for ele in data]
+            data_cat = [dict(zip(ele[0],ele[1])) for ele in data]
+            data_price = [dict(zip(ele[0],ele[2])) for ele in data]
+            my_dict = {}
+            prices = {}
+            for ele in data_cat:
+                my_dict.update(ele)
+            my_dict_cat = {key:categories[value] for key,value in my_dict.items()}
+            for ele in data_price:
+                prices.update(ele)
+            my_dict_price = {key:value for key,value in prices.items()}
+            product_cat_price = [(ele, my_dict_price[ele],my_dict_cat[ele]) for ele in my_dict_cat.keys()]
+            product_cat_price.sort()
+        with traced_transaction(conn, 'step9') as record:
+            insert_values(conn, product_cat_price)
+            record['rows_inserted'] = len(product_cat_price)
+        invalidate_lookups(normalized_database_filename, 'Product', conn)
+        with trace('step9.index'):
+            create_indexes(conn, 'Product')
+        bump_data_version(conn)
+    ### END SOLUTION
+
+
+def step10_create_product_to_productid_dictionary(normalized_database_filename, conn=None):
+    
+    ### BEGIN SOLUTION
+    sql = 'SELECT ProductName, ProductID FROM Product;'
+    return cached_lookup(normalized_database_filename, 'Product', sql, conn)
+
+    ### END SOLUTION
+        
+def order_date_parser():
+    # Returns parse(value, line_number) -> ('YYYY-MM-DD', YYYYMMDD DateKey) for the raw
+    # YYYYMMDD order dates. An extract only holds a few thousand distinct dates, so each
+    # one is validated once and memoized instead of a strptime/strftime per order line.
+    seen = {}
+
+    def parse(value, line_number=None):
+        parsed = seen.get(value)
+        if parsed is None:
+            try:
+                if len(value) != 8 or not (value.isascii() and value.isdigit()):
+                    raise ValueError
+                datetime.date(int(value[:4]), int(value[4:6]), int(value[6:]))
+            except ValueError:
+                raise ValueError('line %s: malformed order date %r' % (line_number, value)) from None
+            parsed = seen[value] = ('%s-%s-%s' % (value[:4], value[4:6], value[6:]), int(value))
+        return parsed
+
+    return parse
+
+def step11_create_orderdetail_table(data_filename, normalized_database_filename, chunk_size=100000, conn=None):
+    # Inputs: Name of the data and normalized database filename
+    # Output: None
+    # Order lines are resolved to CustomerID/ProductID as they are read and inserted
+    # chunk_size rows at a time, so memory stays flat regardless of the extract size.
+
+    
+    ### BEGIN SOLUTION
+    with connection_for(normalized_database_filename, conn) as conn_norm:
+        prod_data = step10_create_product_to_productid_dictionary(normalized_database_filename, conn=conn_norm)
+        cust_data = step6_create_customer_to_customerid_dictionary(normalized_database_filename, conn=conn_norm)
+
+        parse_date = order_date_parser()
+
+        def orderdetail_rows(f, manifest):
+            for line_number, line in enumerate(f, 2):
+                line = line.strip()
+                if not line:
+                    continue
+                manifest.add(line_checksum(line))
+
+                line = line.split('\t')
+
+                quantities_ordered = line[9].split(';')
+                order_date = [parse_date(i, line_number) for i in line[10].split(';')]
+                product = line[5].split(';')
+                cust_id = cust_data[line[0]]
+
+                for prod_name, (date, date_key), quantity in zip(product, order_date, quantities_ordered):
+                    yield (cust_id, prod_data[prod_name], date, date_key, int(quantity))
+
+        create_orddet_query = ORDERDETAIL_TABLE_SQL
+        create_table(conn_norm, create_orddet_query)
+
+        sql_statement = ORDERDETAIL_INSERT_SQL
+        with open(data_filename) as f:
+            next(f)
+            # parsing feeds the inserts chunk by chunk, so step11.insert covers both
+            with traced_transaction(conn_norm, 'step11') as record:
+                record['bytes_read'] = os.path.getsize(data_filename)
+                manifest = LoadManifestWriter(conn_norm, data_filename, chunk_size=chunk_size)
+                record['rows_inserted'] = insert_in_chunks(conn_norm, sql_statement, orderdetail_rows(f, manifest), chunk_size)
+                manifest.close()
+                record['rows_read'] = manifest.line_count
+        finish_orderdetail(conn_norm)
+    ### END SOLUTION
+
+
+# Customer rows, one per data line, are the one part of the dimensions that grows with the
+# extract. Loaders move them from dimensions['customers'] into this temp table a buffer at
+# a time with stage_customers(), and write_dimensions() inserts them from it in order.
+CUSTOMER_STAGE_TABLE_SQL = '''CREATE TEMP TABLE IF NOT EXISTS CustomerStage (
+                CustomerName text not null,
+                Address text not null,
+                City text not null,
+                Country text not null);'''
+
+def new_dimensions():
+    # Dimension rows collected from the extract by add_line_to_dimensions() before
+    # write_dimensions() loads them.
+    return {'regions': set(), 'country_region': {}, 'customers': [], 'categories': {},
+            'product_category': {}, 'product_price': {}}
+
+def add_line_to_dimensions(dimensions, line):
+    # Folds one split data line into dimensions, keeping the same row that step1 - step9
+    # would keep when the extract disagrees with itself.
+
+    # step1 / step3: a country keeps the region that sorts last, like the sorted dict build
+    dimensions['regions'].add(line[4])
+    country_region = dimensions['country_region']
+    country_region[line[3]] = max(line[4], country_region.get(line[3], line[4]))
+
+    # step5: every row is a customer row, buffered until stage_customers()
+    dimensions['customers'].append(tuple(line[:4]))
+
+    # step7: a category keeps the description from the row that sorts last
+    categories = dimensions['categories']
+    key = (line[6], line[7])
+    for category, description in dict(zip(line[6].split(';'), line[7].split(';'))).items():
+        if category not in categories or key >= categories[category][0]:
+            categories[category] = (key, description)
+
+    # step9: products keep the last category and price seen in file order
+    products = line[5].split(';')
+    dimensions['product_category'].update(zip(products, line[6].split(';')))
+    dimensions['product_price'].update(zip(products, line[8].split(';')))
+
+def merge_dimensions(dimensions, later):
+    # Folds the dimensions collected from a later part of the extract into dimensions.
+    dimensions['regions'] |= later['regions']
+    country_region = dimensions['country_region']
+    for country, region in later['country_region'].items():
+        country_region[country] = max(region, country_region.get(country, region))
+    categories = dimensions['categories']
+    for category, (key, description) in later['categories'].items():
+        if category not in categories or key >= categories[category][0]:
+            categories[category] = (key, description)
+    dimensions['product_category'].update(later['product_category'])
+    dimensions['product_price'].update(later['product_price'])
+    if 'order_dates' in later:
+        dimensions.setdefault('order_dates', set()).update(later['order_dates'])
+
+def stage_customers(conn, customers):
+    # Moves the buffered customer rows into the CustomerStage temp table and empties the list.
+    conn.execute(CUSTOMER_STAGE_TABLE_SQL)
+    conn.executemany('INSERT INTO CustomerStage (CustomerName, Address, City, Country) VALUES (?, ?, ?, ?)', customers)
+    customers.clear()
+
+def write_dimensions(conn, normalized_database_filename, dimensions, chunk_size=100000):
+    # Creates and loads Region, Country, Customer, ProductCategory and Product in the
+    # order step1 - step9 do and returns the customer and product name -> id lookups.
+    # Customers are read back from CustomerStage sorted by SQLite, whose BINARY collation
+    # orders them as the sorted() of step5 does, and the stage is dropped afterwards.
+    def insert_values(conn, sql, values):
         cur = conn.cursor()
         cur.executemany(sql, values)
         return cur.lastrowid
-    with open(data_filename, 'r') as file:
-        data = []
-        for line in file:
-            data.append(line.strip().split('\t')[6:8])
-        data = data[1:]
-        data.sort()
-        data = [[ele[0].split(';'),ele[1].split(';')] for ele in data]
-        data = [dict(zip(ele[0],ele[1])) for ele in data]
-        product_dict = {}
-        for ele in data:
-            product_dict.update(ele)
-        product_values = list(product_dict.items())
-        product_values.sort()
+
+    create_table(conn, REGION_TABLE_SQL)
     with conn:
-        insert_values(conn, product_values)
-   
-    ### END SOLUTION
+        insert_values(conn, REGION_INSERT_SQL, [(ele,) for ele in sorted(dimensions['regions'])])
+    invalidate_lookups(normalized_database_filename, 'Region', conn)
+    create_indexes(conn, 'Region')
+    region_ids = step2_create_region_to_regionid_dictionary(normalized_database_filename, conn=conn)
+
+    create_table(conn, COUNTRY_TABLE_SQL)
+    with conn:
+        insert_values(conn, COUNTRY_INSERT_SQL,
+                      [(country, region_ids[region]) for country, region in sorted(dimensions['country_region'].items())])
+    invalidate_lookups(normalized_database_filename, 'Country', conn)
+    create_indexes(conn, 'Country')
+    country_ids = step4_create_country_to_countryid_dictionary(normalized_database_filename, conn=conn)
+
+    create_table(conn, CUSTOMER_TABLE_SQL)
+    stage_customers(conn, dimensions['customers'])
+    stage = conn.execute('SELECT CustomerName, Address, City, Country FROM CustomerStage ORDER BY 1, 2, 3, 4')
+    with conn:
+        insert_in_chunks(conn, CUSTOMER_INSERT_SQL, (tuple(name.split(' ', 1)) + (address, city, country_ids[country])
+                                                     for name, address, city, country in stage), chunk_size)
+    conn.execute('DROP TABLE CustomerStage')
+    invalidate_lookups(normalized_database_filename, 'Customer', conn)
+    create_indexes(conn, 'Customer')
+    customer_ids = step6_create_customer_to_customerid_dictionary(normalized_database_filename, conn=conn)
+
+    create_table(conn, PRODUCTCATEGORY_TABLE_SQL)
+    with conn:
+        insert_values(conn, PRODUCTCATEGORY_INSERT_SQL,
+                      sorted((category, description) for category, (key, description) in dimensions['categories'].items()))
+    invalidate_lookups(normalized_database_filename, 'ProductCategory', conn)
+    create_indexes(conn, 'ProductCategory')
+    category_ids = step8_create_productcategory_to_productcategoryid_dictionary(normalized_database_filename, conn=conn)
+
+    create_table(conn, PRODUCT_TABLE_SQL)
+    product_price = dimensions['product_price']
+    with conn:
+        insert_values(conn, PRODUCT_INSERT_SQL,
+                      sorted((product, product_price[product], category_ids[category])
+                             for product, category in dimensions['product_category'].items()))
+    invalidate_lookups(normalized_database_filename, 'Product', conn)
+    create_indexes(conn, 'Product')
+    product_ids = step10_create_product_to_productid_dictionary(normalized_database_filename, conn=conn)
+
+    return customer_ids, product_ids
+
+def finish_orderdetail(conn, indexes=True):
+    # Post-load work shared by every way of filling OrderDetail. Sharded loads index
+    # their shards themselves and pass indexes=False.
+    if indexes:
+        with trace('finish.index'):
+            create_indexes(conn, 'OrderDetail')
+    with trace('finish.calendar'):
+        refresh_calendar(conn)
+    with trace('finish.totals'):
+        refresh_totals(conn)
+    with trace('finish.gaps'):
+        refresh_customer_gaps(conn)
+    bump_data_version(conn)
+
+def normalize(data_filename, normalized_database_filename, chunk_size=100000, conn=None, bulk_load=False):
+    # Inputs: Name of the data and normalized database filename
+    # Output: None
+    # Builds the same tables as step1 - step11 while reading the data file only once.
+    # Order lines are staged in a temp table against provisional customer/product keys
+    # and copied into OrderDetail, chunk_size rows at a time, once the real ids are known.
+    # bulk_load=True runs the build under bulk_load_settings().
+
+    load_settings = bulk_load_settings if bulk_load else contextlib.nullcontext
+    with connection_for(normalized_database_filename, conn) as conn, load_settings(conn):
+        conn.execute('''CREATE TEMP TABLE OrderStage (
+                CustomerKey integer not null,
+                ProductKey integer not null,
+                OrderDate text not null,
+                DateKey integer not null,
+                QuantityOrdered integer not null,
+                LineChecksum blob);''')
+
+        dimensions = new_dimensions()
+        customer_keys = {}
+        product_keys = {}
+        line_count = 0
+        parse_date = order_date_parser()
+
+        def stage_rows(file):
+            # the line's checksum rides along on its first order row, for LoadManifest, and
+            # the customer rows go to CustomerStage once per chunk_size order rows
+            nonlocal line_count
+            rows = 0
+            for line_number, line in enumerate(file, 2):
+                line = line.strip()
+                if not line:
+                    continue
+                line_count += 1
+                checksum = line_checksum(line)
+                line = line.split('\t')
+                add_line_to_dimensions(dimensions, line)
+
+                # step11
+                customer_key = customer_keys.setdefault(line[0], len(customer_keys))
+                for product, order_date, quantity in zip(line[5].split(';'), line[10].split(';'), line[9].split(';')):
+                    formatted_date, date_key = parse_date(order_date, line_number)
+                    product_key = product_keys.setdefault(product, len(product_keys))
+                    yield (customer_key, product_key, formatted_date, date_key, int(quantity), checksum)
+                    checksum = None
+                    rows += 1
+                if rows >= chunk_size:
+                    stage_customers(conn, dimensions['customers'])
+                    rows = 0
+
+        with open(data_filename, 'r') as file:
+            next(file)
+            with traced_transaction(conn, 'normalize.stage') as record:
+                record['bytes_read'] = os.path.getsize(data_filename)
+                record['rows_inserted'] = insert_in_chunks(conn, ''' INSERT INTO OrderStage (CustomerKey, ProductKey, OrderDate, DateKey, QuantityOrdered, LineChecksum) VALUES(?, ?, ?, ?, ?, ?);''',
+                                                           stage_rows(file), chunk_size)
+                record['rows_read'] = line_count
+
+        with trace('normalize.dimensions'):
+            customer_ids, product_ids = write_dimensions(conn, normalized_database_filename, dimensions, chunk_size)
+
+        customer_lookup = [None] * len(customer_keys)
+        for name, key in customer_keys.items():
+            customer_lookup[key] = customer_ids[name]
+        product_lookup = [None] * len(product_keys)
+        for name, key in product_keys.items():
+            product_lookup[key] = product_ids[name]
+
+        create_table(conn, ORDERDETAIL_TABLE_SQL)
+        stage = conn.cursor()
+        stage.execute('SELECT CustomerKey, ProductKey, OrderDate, DateKey, QuantityOrdered FROM OrderStage ORDER BY rowid')
+        with traced_transaction(conn, 'normalize.orderdetail') as record:
+            record['rows_inserted'] = insert_in_chunks(conn, ORDERDETAIL_INSERT_SQL,
+                                                       ((customer_lookup[c], product_lookup[p], d, k, q) for c, p, d, k, q in stage), chunk_size)
+            manifest = LoadManifestWriter(conn, data_filename)
+            conn.execute('INSERT OR IGNORE INTO LoadManifest (LineChecksum, LoadID) '
+                         'SELECT LineChecksum, ? FROM OrderStage WHERE LineChecksum IS NOT NULL', (manifest.load_id,))
+            manifest.line_count = line_count
+            manifest.close()
+        finish_orderdetail(conn)
+        conn.execute('DROP TABLE OrderStage')
+
+
+def split_byte_ranges(data_filename, parts):
+    # Splits the data lines of the file (everything after the header) into about `parts`
+    # (start, end) byte ranges. A line belongs to the range its first byte falls in.
+    with open(data_filename, 'rb') as f:
+        f.readline()
+        first = f.tell()
+        size = os.fstat(f.fileno()).st_size
+    step = max(1, -(-(size - first) // parts))
+    return [(start, min(start + step, size)) for start in range(first, size, step)]
+
+def read_range_lines(data_filename, start, end):
+    encoding = locale.getpreferredencoding(False)
+    with open(data_filename, 'rb') as f:
+        f.seek(start - 1)
+        f.readline()
+        position = f.tell()
+        while position < end:
+            line = f.readline()
+            if not line:
+                break
+            position += len(line)
+            yield line.decode(encoding)
+
+def parse_range_dimensions(data_filename, start, end, order_dates=False):
+    # Worker for normalize_parallel(): the dimensions of one byte range and its line count.
+    # order_dates=True also collects the distinct raw order dates in dimensions['order_dates'].
+    dimensions = new_dimensions()
+    if order_dates:
+        dimensions['order_dates'] = set()
+    line_count = 0
+    for line in read_range_lines(data_filename, start, end):
+        line_count += 1
+        line = line.strip()
+        if line:
+            line = line.split('\t')
+            add_line_to_dimensions(dimensions, line)
+            if order_dates:
+                dimensions['order_dates'].update(line[10].split(';'))
+    return dimensions, line_count
+
+_worker_lookups = None
+
+def set_worker_lookups(customer_ids, product_ids):
+    global _worker_lookups
+    _worker_lookups = (customer_ids, product_ids)
+
+def worker_lookups(*lookups):
+    # The lookups as set_worker_lookups() arguments; the read-only dict views cached
+    # lookups come as do not pickle, so they are sent as copies.
+    return tuple(lookup.copy() if isinstance(lookup, types.MappingProxyType) else lookup for lookup in lookups)
+
+def parse_range_orders(data_filename, start, end, first_line_number):
+    # Worker for normalize_parallel(): the OrderDetail rows and line checksums of one byte range.
+    customer_ids, product_ids = _worker_lookups
+    parse_date = order_date_parser()
+    rows = []
+    checksums = []
+    for line_number, line in enumerate(read_range_lines(data_filename, start, end), first_line_number):
+        line = line.strip()
+        if not line:
+            continue
+        checksums.append(line_checksum(line))
+        line = line.split('\t')
+        customer_id = customer_ids[line[0]]
+        for product, order_date, quantity in zip(line[5].split(';'), line[10].split(';'), line[9].split(';')):
+            formatted_date, date_key = parse_date(order_date, line_number)
+            rows.append((customer_id, product_ids[product], formatted_date, date_key, int(quantity)))
+    return rows, checksums
+
+def parse_dimensions_parallel(conn, data_filename, ranges, workers, order_dates=False):
+    # The merged dimensions of every byte range, parsed on a process pool, the line number
+    # each range starts at and the number of data lines. The customer rows of each range
+    # go to stage_customers() on conn as the range comes back, and at most 2 * workers
+    # ranges are in flight, so only their customer rows are held at any time.
+    dimensions = new_dimensions()
+    first_line_numbers = []
+    line_number = 2
+
+    def merge_range(future):
+        nonlocal line_number
+        range_dimensions, line_count = future.result()
+        stage_customers(conn, range_dimensions['customers'])
+        merge_dimensions(dimensions, range_dimensions)
+        first_line_numbers.append(line_number)
+        line_number += line_count
+
+    with concurrent.futures.ProcessPoolExecutor(workers) as pool:
+        pending = collections.deque()
+        for start, end in ranges:
+            pending.append(pool.submit(parse_range_dimensions, data_filename, start, end, order_dates))
+            if len(pending) >= 2 * workers:
+                merge_range(pending.popleft())
+        while pending:
+            merge_range(pending.popleft())
+    return dimensions, first_line_numbers, line_number - 2
+
+def normalize_parallel(data_filename, normalized_database_filename, workers=None, chunk_size=100000,
+                       conn=None, bulk_load=False, range_size=32 << 20):
+    # Inputs: Name of the data and normalized database filename
+    # Output: None
+    # normalize() with the parsing spread over a process pool. The file is split into
+    # newline-aligned byte ranges of about range_size bytes. A first pass collects and
+    # merges the dimensions of every range, which are loaded with the same sorted ids as
+    # normalize(). A second pass turns each range into OrderDetail rows, which this
+    # process inserts in file order while at most 2 * workers ranges are in flight.
+    workers = workers or os.cpu_count()
+    parts = max(workers, -(-os.path.getsize(data_filename) // range_size))
+    ranges = split_byte_ranges(data_filename, parts)
+
+    load_settings = bulk_load_settings if bulk_load else contextlib.nullcontext
+    with connection_for(normalized_database_filename, conn) as conn, load_settings(conn):
+        with trace('normalize_parallel.parse', bytes_read=os.path.getsize(data_filename)) as record:
+            dimensions, first_line_numbers, record['rows_read'] = parse_dimensions_parallel(conn, data_filename, ranges, workers)
+
+        with trace('normalize_parallel.dimensions'):
+            customer_ids, product_ids = write_dimensions(conn, normalized_database_filename, dimensions, chunk_size)
+        dimensions = None
+
+        create_table(conn, ORDERDETAIL_TABLE_SQL)
+        sql_statement = ORDERDETAIL_INSERT_SQL
+        with concurrent.futures.ProcessPoolExecutor(workers, initializer=set_worker_lookups,
+                                                    initargs=worker_lookups(customer_ids, product_ids)) as pool, \
+                traced_transaction(conn, 'normalize_parallel.orderdetail') as record:
+            pending = collections.deque()
+            manifest = LoadManifestWriter(conn, data_filename, chunk_size=chunk_size)
+            record['rows_inserted'] = 0
+
+            def write_range(future):
+                rows, range_checksums = future.result()
+                record['rows_inserted'] += insert_in_chunks(conn, sql_statement, rows, chunk_size)
+                manifest.extend(range_checksums)
+
+            for (start, end), first_line_number in zip(ranges, first_line_numbers):
+                pending.append(pool.submit(parse_range_orders, data_filename, start, end, first_line_number))
+                if len(pending) >= 2 * workers:
+                    write_range(pending.popleft())
+            while pending:
+                write_range(pending.popleft())
+            manifest.close()
+        finish_orderdetail(conn)
+
+def append(data_filename, normalized_database_filename, chunk_size=100000, conn=None):
+    # Inputs: Name of a delta data file and the normalized database filename
+    # Output: Number of data lines loaded
+    # Loads a delta extract into an existing database. Lines whose checksum is already in
+    # LoadManifest are skipped, unseen regions, countries, customers, categories and
+    # products are added after the existing ids, and the new order lines are appended
+    # to OrderDetail. A database without tables gets a full normalize() instead.
+    with connection_for(normalized_database_filename, conn) as conn:
+        if not execute_sql_statement("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'Region'", conn):
+            normalize(data_filename, normalized_database_filename, chunk_size, conn=conn)
+            return execute_sql_statement('SELECT LineCount FROM LoadFile ORDER BY LoadID DESC LIMIT 1', conn)[0][0]
+        if shard_files(conn):
+            raise ValueError('%s is sharded, rebuild it with normalize_sharded() to load more data'
+                             % normalized_database_filename)
+
+        create_table(conn, ORDERDETAIL_TABLE_SQL)
+        for sql in LOAD_MANIFEST_TABLE_SQL:
+            create_table(conn, sql)
+        seen_sql = 'SELECT 1 FROM LoadManifest WHERE LineChecksum = ?'
+        lines = []
+        skipped_count = 0
+        with trace('append.parse', bytes_read=os.path.getsize(data_filename)) as record, open(data_filename, 'r') as file:
+            next(file)
+            for line_number, line in enumerate(file, 2):
+                line = line.strip()
+                if not line:
+                    continue
+                checksum = line_checksum(line)
+                if conn.execute(seen_sql, (checksum,)).fetchone():
+                    skipped_count += 1
+                else:
+                    lines.append((line_number, checksum, line.split('\t')))
+            record['rows_read'] = len(lines) + skipped_count
+
+        dimensions = new_dimensions()
+        for line_number, checksum, line in lines:
+            add_line_to_dimensions(dimensions, line)
+
+        def add_rows(table, sql, rows):
+            if rows:
+                with traced_transaction(conn, 'append.%s' % table) as record:
+                    conn.executemany(sql, sorted(rows))
+                    record['rows_inserted'] = len(rows)
+                invalidate_lookups(normalized_database_filename, table, conn)
+
+        region_ids = step2_create_region_to_regionid_dictionary(normalized_database_filename, conn=conn)
+        add_rows('Region', REGION_INSERT_SQL,
+                 [(region,) for region in dimensions['regions'] if region not in region_ids])
+        region_ids = step2_create_region_to_regionid_dictionary(normalized_database_filename, conn=conn)
+
+        country_ids = step4_create_country_to_countryid_dictionary(normalized_database_filename, conn=conn)
+        add_rows('Country', COUNTRY_INSERT_SQL,
+                 [(country, region_ids[region]) for country, region in dimensions['country_region'].items()
+                  if country not in country_ids])
+        country_ids = step4_create_country_to_countryid_dictionary(normalized_database_filename, conn=conn)
+
+        # a new customer gets the row that sorts last, the one a full build's lookup keeps
+        customer_ids = step6_create_customer_to_customerid_dictionary(normalized_database_filename, conn=conn)
+        new_customers = {customer[0]: customer for customer in sorted(dimensions['customers'])
+                         if customer[0] not in customer_ids}
+        add_rows('Customer', CUSTOMER_INSERT_SQL,
+                 [tuple(name.split(' ', 1)) + (address, city, country_ids[country])
+                  for name, address, city, country in new_customers.values()])
+        customer_ids = step6_create_customer_to_customerid_dictionary(normalized_database_filename, conn=conn)
+
+        category_ids = step8_create_productcategory_to_productcategoryid_dictionary(normalized_database_filename, conn=conn)
+        add_rows('ProductCategory', PRODUCTCATEGORY_INSERT_SQL,
+                 [(category, description) for category, (key, description) in dimensions['categories'].items()
+                  if category not in category_ids])
+        category_ids = step8_create_productcategory_to_productcategoryid_dictionary(normalized_database_filename, conn=conn)
+
+        product_ids = step10_create_product_to_productid_dictionary(normalized_database_filename, conn=conn)
+        product_price = dimensions['product_price']
+        add_rows('Product', PRODUCT_INSERT_SQL,
+                 [(product, product_price[product], category_ids[category])
+                  for product, category in dimensions['product_category'].items() if product not in product_ids])
+        product_ids = step10_create_product_to_productid_dictionary(normalized_database_filename, conn=conn)
+
+        parse_date = order_date_parser()
+
+        def orderdetail_rows():
+            for line_number, checksum, line in lines:
+                customer_id = customer_ids[line[0]]
+                for product, order_date, quantity in zip(line[5].split(';'), line[10].split(';'), line[9].split(';')):
+                    formatted_date, date_key = parse_date(order_date, line_number)
+                    yield (customer_id, product_ids[product], formatted_date, date_key, int(quantity))
+
+        with traced_transaction(conn, 'append.orderdetail') as record:
+            record['rows_inserted'] = insert_in_chunks(conn, ORDERDETAIL_INSERT_SQL, orderdetail_rows(), chunk_size)
+            record_load(conn, data_filename, [checksum for line_number, checksum, line in lines], skipped_count)
+        finish_orderdetail(conn)
+        return len(lines)
+
+
+# Sharded layout. normalize_sharded() keeps the dimension, Calendar, totals, gap and
+# manifest tables in the main database and splits OrderDetail by order year or by the
+# customer's region into shard databases next to it, listed in its Shard table. Every
+# shard is written by its own thread, so the inserts into different files run side by
+# side. Reads go one of two ways: attach_shards() (and ShardedDatabase) ATTACHes the
+# shards behind a temp OrderDetail view, which the ex queries, the numpy engine and the
+# refresh_* helpers read unchanged; fanout_aggregate() runs one partial aggregate per
+# shard on a thread pool and adds up the partial sums.
+SHARD_KEYS = ('year', 'region')
+
+SHARD_TABLE_SQL = '''create table if not exists Shard (
+            ShardID integer primary key not null,
+            ShardKey integer not null,
+            FileName text not null);'''
+
+# OrderDetail in a shard; the tables it refers to are in the main database
+SHARD_ORDERDETAIL_TABLE_SQL = '''create table if not exists OrderDetail (
+            OrderID integer primary key not null,
+            CustomerID integer not null,
+            ProductID integer not null,
+            OrderDate integer not null,
+            DateKey integer not null,
+            QuantityOrdered integer not null);'''
+
+SHARD_ORDERDETAIL_INSERT_SQL = ('INSERT INTO OrderDetail (OrderID, CustomerID, ProductID, OrderDate, DateKey, '
+                                'QuantityOrdered) VALUES (?, ?, ?, ?, ?, ?)')
+
+FANOUT_GROUPS = {
+    'customer': ('o.CustomerID',),
+    'country': ('c.CountryID',),
+    'region': ('ct.RegionID',),
+    'quarter': ('d.Quarter', 'd.Year'),
+    'customer_quarter': ('d.Quarter', 'd.Year', 'o.CustomerID'),
+    'month': ('d.MonthName',),
+}
+
+FANOUT_MEASURES = {
+    'sales': 'SUM(p.ProductUnitPrice * o.QuantityOrdered)',
+    'rounded_sales': 'SUM(ROUND(p.ProductUnitPrice * o.QuantityOrdered))',
+    'quantity': 'SUM(o.QuantityOrdered)',
+    'orders': 'COUNT(*)',
+}
+
+def shard_files(conn):
+    # (ShardKey, path) of every shard of the database on conn; [] when it is not sharded.
+    if not execute_sql_statement("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'Shard'", conn):
+        return []
+    directory = os.path.dirname(database_key(None, conn))
+    return [(key, os.path.join(directory, filename))
+            for key, filename in conn.execute('SELECT ShardKey, FileName FROM Shard ORDER BY ShardID')]
+
+def attach_shards(conn, read_only=False):
+    # ATTACHes the shards of the database on conn as shard0, shard1, ... and creates the
+    # temp OrderDetail view over them, which shadows any main.OrderDetail on this
+    # connection. read_only attaches them with mode=ro, for connections opened with
+    # uri=True. Returns the number of shards.
+    shards = shard_files(conn)
+    limit = conn.getlimit(sqlite3.SQLITE_LIMIT_ATTACHED)
+    if len(shards) > limit:
+        raise ValueError('%d shards are more than the %d databases SQLite can attach, use fanout_aggregate()'
+                         % (len(shards), limit))
+    selects = []
+    for position, (key, path) in enumerate(shards):
+        name = 'file:%s?mode=ro' % urllib.request.pathname2url(path) if read_only else path
+        conn.execute('ATTACH DATABASE ? AS shard%d' % position, (name,))
+        selects.append('SELECT * FROM shard%d.OrderDetail' % position)
+    if selects:
+        conn.execute('CREATE TEMP VIEW IF NOT EXISTS OrderDetail AS %s' % ' UNION ALL '.join(selects))
+    return len(shards)
+
+def write_shard(conn, rows, chunk_size):
+    with conn:
+        return insert_in_chunks(conn, SHARD_ORDERDETAIL_INSERT_SQL, rows, chunk_size)
+
+def finish_shard(conn):
+    create_indexes(conn, 'OrderDetail')
+    conn.close()
+
+def group_shard_keys(keys, limit):
+    # {key: first key of its run} for the sorted keys split into at most limit runs of
+    # neighbouring keys, so a build never makes more shards than SQLite can attach.
+    first_keys = {}
+    return {key: first_keys.setdefault(position * limit // len(keys), key) for position, key in enumerate(keys)}
+
+def normalize_sharded(data_filename, normalized_database_filename, by='year', workers=None, chunk_size=100000,
+                      range_size=32 << 20):
+    # Inputs: Name of the data and normalized database filename
+    # Output: None
+    # normalize_parallel() into the sharded layout, with OrderDetail split by order year
+    # or by customer region (by='year' / 'region') into <database>.<by>-<key>.db files.
+    # When there are more years or regions than SQLite can attach, neighbouring ones share
+    # a shard, named <database>.<by>-<first>-<last>.db, whose ShardKey is the first.
+    # Ids, OrderIDs and every main database table come out as normalize() makes them. The
+    # shard files are removed again if the build fails.
+    if by not in SHARD_KEYS:
+        raise ValueError('by must be one of %s, not %r' % (', '.join(SHARD_KEYS), by))
+    key = database_key(normalized_database_filename)
+    if key is None:
+        raise ValueError('Shards need a database file, not %r' % normalized_database_filename)
+    workers = workers or os.cpu_count()
+    parts = max(workers, -(-os.path.getsize(data_filename) // range_size))
+    ranges = split_byte_ranges(data_filename, parts)
+
+    with connection_for(normalized_database_filename) as conn:
+        with trace('normalize_sharded.parse', bytes_read=os.path.getsize(data_filename)) as record:
+            dimensions, first_line_numbers, record['rows_read'] = parse_dimensions_parallel(
+                conn, data_filename, ranges, workers, order_dates=(by == 'year'))
+        if by == 'year':
+            parse_date = order_date_parser()
+            shard_keys = set()
+            for order_date in dimensions.pop('order_dates', ()):
+                try:
+                    shard_keys.add(parse_date(order_date)[1] // 10000)
+                except ValueError:
+                    pass  # reported with its line number by parse_range_orders()
+        with trace('normalize_sharded.dimensions'):
+            customer_ids, product_ids = write_dimensions(conn, normalized_database_filename, dimensions, chunk_size)
+        dimensions = None
+        if by == 'region':
+            customer_regions = dict(conn.execute('SELECT c.CustomerID, ct.RegionID FROM Customer c '
+                                                 'JOIN Country ct ON c.CountryID = ct.CountryID'))
+            shard_keys = set(customer_regions.values())
+        shard_of = group_shard_keys(sorted(shard_keys), conn.getlimit(sqlite3.SQLITE_LIMIT_ATTACHED)) if shard_keys else {}
+        last_keys = {shard_key: last_key for last_key, shard_key in shard_of.items()}
+        create_table(conn, SHARD_TABLE_SQL)
+
+        # shard key -> [connection, single-thread writer, pending writes]
+        shards = {}
+        paths = []
+        order_id = 0
+        try:
+            with trace('normalize_sharded.orderdetail') as record, \
+                    concurrent.futures.ProcessPoolExecutor(workers, initializer=set_worker_lookups,
+                                                           initargs=worker_lookups(customer_ids, product_ids)) as pool:
+                record['rows_inserted'] = 0
+                manifest = LoadManifestWriter(conn, data_filename, chunk_size=chunk_size)
+
+                def write_range(future):
+                    nonlocal order_id
+                    rows, range_checksums = future.result()
+                    manifest.extend(range_checksums)
+                    buckets = collections.defaultdict(list)
+                    for row in rows:
+                        order_id += 1
+                        row_key = row[3] // 10000 if by == 'year' else customer_regions[row[0]]
+                        buckets[shard_of[row_key]].append((order_id,) + row)
+                    for shard_key, shard_rows in buckets.items():
+                        if shard_key not in shards:
+                            label = shard_key if last_keys[shard_key] == shard_key else '%s-%s' % (shard_key, last_keys[shard_key])
+                            path = '%s.%s-%s.db' % (os.path.splitext(key)[0], by, label)
+                            if os.path.exists(path):
+                                os.remove(path)
+                            paths.append(path)
+                            shard_conn = sqlite3.connect(path, check_same_thread=False)
+                            create_table(shard_conn, SHARD_ORDERDETAIL_TABLE_SQL)
+                            conn.execute('INSERT INTO Shard (ShardKey, FileName) VALUES (?, ?)',
+                                         (shard_key, os.path.basename(path)))
+                            shards[shard_key] = [shard_conn, concurrent.futures.ThreadPoolExecutor(1), collections.deque()]
+                        shard_conn, writer, shard_pending = shards[shard_key]
+                        shard_pending.append(writer.submit(write_shard, shard_conn, shard_rows, chunk_size))
+                        while len(shard_pending) > 2:
+                            record['rows_inserted'] += shard_pending.popleft().result()
+
+                pending = collections.deque()
+                for (start, end), first_line_number in zip(ranges, first_line_numbers):
+                    pending.append(pool.submit(parse_range_orders, data_filename, start, end, first_line_number))
+                    if len(pending) >= 2 * workers:
+                        write_range(pending.popleft())
+                while pending:
+                    write_range(pending.popleft())
+                with trace('normalize_sharded.index'):
+                    for shard_conn, writer, shard_pending in shards.values():
+                        shard_pending.append(writer.submit(finish_shard, shard_conn))
+                    for shard_conn, writer, shard_pending in shards.values():
+                        for write in shard_pending:
+                            record['rows_inserted'] += write.result() or 0
+                        writer.shutdown()
+                manifest.close()
+            conn.commit()
+            attach_shards(conn)
+            finish_orderdetail(conn, indexes=False)
+        except BaseException:
+            for shard_conn, writer, shard_pending in shards.values():
+                writer.shutdown(cancel_futures=True)
+                shard_conn.close()
+            conn.rollback()
+            for schema, in conn.execute("SELECT name FROM pragma_database_list WHERE name LIKE 'shard%'").fetchall():
+                conn.execute('DETACH DATABASE %s' % schema)
+            conn.execute('DELETE FROM Shard')
+            conn.commit()
+            for path in paths:
+                if os.path.exists(path):
+                    os.remove(path)
+            raise
+
+def fanout_aggregate(normalized_database_filename, group_by='customer', measure='sales', workers=None):
+    # {group: total} of measure over the OrderDetail rows of every shard, from one
+    # partial aggregate per shard run on a thread pool (sqlite3 releases the GIL while a
+    # statement runs) and summed here. A group of one column is keyed by its value, a
+    # group of more by a tuple. The dimension tables come from the main database, which
+    # each shard connection attaches. Floating point sums can differ from a single
+    # database's in the last bits, since they are added up in a different order.
+    for argument, value, choices in (('group_by', group_by, FANOUT_GROUPS), ('measure', measure, FANOUT_MEASURES)):
+        if value not in choices:
+            raise ValueError('%s must be one of %s, not %r' % (argument, ', '.join(choices), value))
+    main = database_key(normalized_database_filename)
+    with connection_for(normalized_database_filename) as conn:
+        shards = shard_files(conn)
+    if not shards:
+        raise ValueError('%s is not sharded' % normalized_database_filename)
+    sql = aggregate_statement(list(FANOUT_GROUPS[group_by]) + [FANOUT_MEASURES[measure]])
+
+    def partial(path):
+        shard = sqlite3.connect('file:%s?mode=ro' % urllib.request.pathname2url(path), uri=True)
+        try:
+            shard.execute('ATTACH DATABASE ? AS dimensions', ('file:%s?mode=ro' % urllib.request.pathname2url(main),))
+            return shard.execute(sql).fetchall()
+        finally:
+            shard.close()
+
+    totals = {}
+    with trace('fanout.%s' % group_by) as record, \
+            concurrent.futures.ThreadPoolExecutor(workers or min(len(shards), os.cpu_count())) as pool:
+        for rows in pool.map(partial, [path for shard_key, path in shards]):
+            record['rows_read'] = record.get('rows_read', 0) + len(rows)
+            for row in rows:
+                group = row[0] if len(row) == 2 else row[:-1]
+                totals[group] = totals.get(group, 0) + row[-1]
+    return totals
+
+def benchmark_shards(normalized_database_filename, sharded_database_filename, repeat=3):
+    # Best wall time in seconds of the per-customer sales total on a single database, on
+    # the shards through attach_shards() and with fanout_aggregate(), and of ex9 on both.
+    sql = aggregate_statement(list(FANOUT_GROUPS['customer']) + [FANOUT_MEASURES['sales']])
+    single = create_connection(normalized_database_filename)
+    sharded = create_connection(sharded_database_filename)
+    attach_shards(sharded)
+    timings = {}
+    try:
+        for name, run in (('single', lambda: single.execute(sql).fetchall()),
+                          ('attached', lambda: sharded.execute(sql).fetchall()),
+                          ('fanout', lambda: fanout_aggregate(sharded_database_filename)),
+                          ('single_ex9', lambda: run_query(single, 'ex9', result_format='tuples')),
+                          ('attached_ex9', lambda: run_query(sharded, 'ex9', result_format='tuples'))):
+            timings[name] = best_time(run, repeat)
+    finally:
+        single.close()
+        sharded.close()
+    return timings
+
+
+def best_time(run, repeat=3, setup=None):
+    # Best wall time in seconds of repeat calls of run(), each after an untimed setup().
+    best = None
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        run()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def remove_database(normalized_database_filename):
+    if os.path.exists(normalized_database_filename):
+        os.remove(normalized_database_filename)
+
+def benchmark_bulk_load(data_filename, normalized_database_filename, repeat=3):
+    # Rebuilds normalized_database_filename with normalize() repeat times with and without
+    # bulk_load and returns the best wall time in seconds for each mode.
+    timings = {}
+    for bulk_load in (False, True):
+        timings['bulk_load' if bulk_load else 'default'] = best_time(
+            lambda: normalize(data_filename, normalized_database_filename, bulk_load=bulk_load), repeat,
+            setup=lambda: remove_database(normalized_database_filename))
+    return timings
+
+
+def benchmark_date_parsing(values, repeat=3):
+    # Best wall time in seconds of formatting every YYYYMMDD string in values with the
+    # per-value strptime/strftime round trip and with order_date_parser().
+    def with_strptime():
+        for value in values:
+            datetime.datetime.strptime(value, '%Y%m%d').strftime('%Y-%m-%d')
 
-def step8_create_productcategory_to_productcategoryid_dictionary(normalized_database_filename):
-    
-    
-    ### BEGIN SOLUTION
-    conn = create_connection(normalized_database_filename)
-    sql = 'SELECT ProductCategory, ProductCategoryID FROM ProductCategory;'
-    product_categories = execute_sql_statement(sql, conn)
-    return dict(product_categories)
+    def with_parser():
+        parse = order_date_parser()
+        for value in values:
+            parse(value)
 
-    ### END SOLUTION
-        
+    return {'strptime': best_time(with_strptime, repeat), 'order_date_parser': best_time(with_parser, repeat)}
 
-def step9_create_product_table(data_filename, normalized_database_filename):
-    # Inputs: Name of the data and normalized database filename
-    # Output: None
 
-    
-    ### BEGIN SOLUTION
-    conn = create_connection(normalized_database_filename)
-    sql = '''CREATE TABLE Product (
-                    ProductID integer not null Primary key,
-                    ProductName Text not null,
-                    ProductUnitPrice Real not null,
-                    ProductCategoryID integer not null,
-                    foreign key (ProductCategoryID) REFERENCES ProductCategory (ProductCategoryID));'''
-    create_table(conn, sql)
-    def insert_values(conn, values):
-        sql = ''' INSERT INTO Product (ProductName, ProductUnitPrice, ProductCategoryID) VALUES(?, ?, ?);'''
-        cur = conn.cursor()
-        cur.executemany(sql, values)
-        return cur.lastrowid
-    categories = step8_create_productcategory_to_productcategoryid_dictionary(normalized_database_filename)
-    with open(data_filename, 'r') as file:
-        data = []
-        for line in file:
-            data.append(line.strip().split('\t')[5:9])
-        data = data[1:]
-        data = [[ele[0].split(';'),ele[1].split(';'),ele[3].split(';')] for ele in data]
-        data_cat = [dict(zip(ele[0],ele[1])) for ele in data]
-        data_price = [dict(zip(ele[0],ele[2])) for ele in data]
-        my_dict = {}
-        prices = {}
-        for ele in data_cat:
-            my_dict.update(ele)
-        my_dict_cat = {key:categories[value] for key,value in my_dict.items()}
-        for ele in data_price:
-            prices.update(ele)
-        my_dict_price = {key:value for key,value in prices.items()}
-        product_cat_price = [(ele, my_dict_price[ele],my_dict_cat[ele]) for ele in my_dict_cat.keys()]
-        product_cat_price.sort()
-        with conn:
-            insert_values(conn, product_cat_price)
-    ### END SOLUTION
+def benchmark_name_index(count=1000000, lookups=100000, seed=0):
+    # Builds a count-name customer lookup as a dict and as a NameIndex and returns the bytes
+    # each one allocates (tracemalloc) and the seconds each takes for lookups random hits.
+    import tracemalloc
+    rng = random.Random(seed)
+    def rows():
+        return (('First%d Last%d' % (i % 1000, i), i + 1) for i in range(count))
 
+    report = {}
+    for name, build in (('dict', lambda: dict(rows())),
+                        ('name_index', lambda: NameIndex.from_sorted_rows(
+                            sorted(rows(), key=lambda row: row[0].encode('utf-8'))))):
+        tracemalloc.start()
+        lookup = build()
+        report[name + '_bytes'] = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        names = ['First%d Last%d' % (i % 1000, i) for i in (rng.randrange(count) for _ in range(lookups))]
+        start = time.perf_counter()
+        for customer in names:
+            lookup[customer]
+        report[name + '_lookup_seconds'] = time.perf_counter() - start
+        del lookup
+    return report
 
-def step10_create_product_to_productid_dictionary(normalized_database_filename):
-    
-    ### BEGIN SOLUTION
-    conn = create_connection(normalized_database_filename)
-    sql = 'SELECT ProductName, ProductID FROM Product;'
-    products = execute_sql_statement(sql, conn)
-    return dict(products)
 
-    ### END SOLUTION
-        
-import datetime
-def step11_create_orderdetail_table(data_filename, normalized_database_filename):
-    # Inputs: Name of the data and normalized database filename
-    # Output: None
+# Synthetic extracts and a benchmark harness for the load steps and the ex queries.
+SYNTHETIC_REGIONS = ['Africa', 'Asia', 'Europe', 'North America', 'South America']
 
-    
-    ### BEGIN SOLUTION
-    conn_norm = create_connection(normalized_database_filename)   
-    data = []
+def generate_sales_data(data_filename, order_lines, customers=None, products=100, categories=10,
+                        countries=20, max_products_per_line=6, seed=0):
+    # Writes a tab-separated extract in the layout step1 - step11 parse with order_lines
+    # order lines spread over lines of 1 - max_products_per_line products each. Every
+    # customer, country, product and category keeps the same attributes on every line, and
+    # the same seed writes the same file. Returns the number of data lines written.
+    rng = random.Random(seed)
+    customers = customers or max(10, order_lines // 20)
+    country_region = [SYNTHETIC_REGIONS[i % len(SYNTHETIC_REGIONS)] for i in range(countries)]
+    product_rows = []
+    for i in range(products):
+        category = rng.randrange(categories)
+        product_rows.append(('Product%05d' % i, 'Category%02d' % category, 'Description of category %02d' % category,
+                             '%.2f' % rng.uniform(1, 500)))
+    first_day = datetime.date(2009, 1, 1).toordinal()
+    last_day = datetime.date(2014, 12, 31).toordinal()
+    dates = {}
 
-    with open(data_filename) as f:
-        next(f)
-        for line in f:
-            line = line.strip()
-            if not line:
-                continue
-                
-            line = line.split('\t')
-            
-            quantities_ordered = line[9].split(';')
-            order_date = line[10].split(';')
-            formatted_date = []
-            for i in order_date:
-                i = datetime.datetime.strptime(i, '%Y%m%d').strftime('%Y-%m-%d')
-                formatted_date.append(i)
-            product = line[5].split(';')
-            customer_name = [line[0]]*len(formatted_date)
-
-            orddet_data = list(zip(customer_name, product, formatted_date, quantities_ordered))
-            for i in orddet_data:
-                data.append(i)
-        orddet_data = data
-        prod_data = step10_create_product_to_productid_dictionary(normalized_database_filename)
-        cust_data = step6_create_customer_to_customerid_dictionary(normalized_database_filename)
-        
-        orddet_table_output = []
-        for i in orddet_data:
-            cust_id = cust_data[i[0]]
-            prod_id = prod_data[i[1]]
-            orddet_table_output.append((cust_id, prod_id, i[2], int(i[3])))
-        
-        create_orddet_query = '''create table if not exists OrderDetail (
-            OrderID integer primary key not null, 
-            CustomerID inetger not null, 
-            ProductID integer not null, 
-            OrderDate integer not null, 
-            QuantityOrdered integer not null, 
-            foreign key(CustomerID) references Customer(CustomerID), 
-            foreign key(ProductID) references Product(ProductID));'''
-        create_table(conn_norm, create_orddet_query)
+    lines = 0
+    with open(data_filename, 'w') as f:
+        f.write('Name\tAddress\tCity\tCountry\tRegion\tProductName\tProductCategory\tProductCategoryDescription\t'
+                'ProductUnitPrice\tQuantityOrderded\tOrderDate\n')
+        written = 0
+        while written < order_lines:
+            customer = rng.randrange(customers)
+            country = customer % countries
+            count = min(rng.randint(1, max_products_per_line), order_lines - written)
+            items = [product_rows[rng.randrange(products)] for _ in range(count)]
+            days = [rng.randint(first_day, last_day) for _ in range(count)]
+            for day in days:
+                if day not in dates:
+                    dates[day] = datetime.date.fromordinal(day).strftime('%Y%m%d')
+            f.write('\t'.join([
+                'First%d Last%d' % (customer % 1000, customer), '%d Main St' % customer, 'City%d' % (customer % 500),
+                'Country%02d' % country, country_region[country],
+                ';'.join(item[0] for item in items), ';'.join(item[1] for item in items),
+                ';'.join(item[2] for item in items), ';'.join(item[3] for item in items),
+                ';'.join(str(rng.randint(1, 20)) for _ in items), ';'.join(dates[day] for day in days)]) + '\n')
+            written += count
+            lines += 1
+    return lines
 
-        def insert_product(conn_norm, values):
-            sql_statement = "insert into OrderDetail(CustomerID, ProductID, OrderDate, QuantityOrdered) values(?, ?, ?, ?);"
-            cur = conn_norm.cursor()
-            cur.executemany(sql_statement, values)
-            return cur.lastrowid
-        
-        with conn_norm:
-            insert_product(conn_norm, orddet_table_output)
-    ### END SOLUTION
+def run_benchmark(data_filename, normalized_database_filename, trace_memory=False):
+    # Times step1 - step11 on a fresh database, normalize() on another fresh one, and every
+    # ex query on both engines, and returns a report dict that json.dump() can write:
+    #   {'data_filename': ..., 'data_bytes': ..., 'order_lines': ..., 'database_bytes': ...,
+    #    'python': ..., 'sqlite': ..., 'platform': ...,
+    #    'timings': [{'name': 'step1', 'seconds': ..., 'max_rss_bytes': ...}, ...]}
+    # max_rss_bytes is the process high-water mark after the step. trace_memory=True also
+    # records the step's own peak of Python allocations as 'peak_python_bytes', at the cost
+    # of slower timings.
+    try:
+        import resource
+    except ImportError:
+        resource = None
+    import platform
+    import tracemalloc
+
+    timings = []
+
+    def timed(name, run):
+        if trace_memory:
+            tracemalloc.start()
+        start = time.perf_counter()
+        result = run()
+        timing = {'name': name, 'seconds': time.perf_counter() - start}
+        if trace_memory:
+            timing['peak_python_bytes'] = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        if resource is not None:
+            # ru_maxrss is in kilobytes on Linux
+            timing['max_rss_bytes'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+        timings.append(timing)
+        return result
+
+    def fresh(filename):
+        if os.path.exists(filename):
+            os.remove(filename)
+        invalidate_lookups(filename)
+        return filename
+
+    db = fresh(normalized_database_filename)
+    steps = [
+        ('step1', lambda: step1_create_region_table(data_filename, db)),
+        ('step2', lambda: step2_create_region_to_regionid_dictionary(db)),
+        ('step3', lambda: step3_create_country_table(data_filename, db)),
+        ('step4', lambda: step4_create_country_to_countryid_dictionary(db)),
+        ('step5', lambda: step5_create_customer_table(data_filename, db)),
+        ('step6', lambda: step6_create_customer_to_customerid_dictionary(db)),
+        ('step7', lambda: step7_create_productcategory_table(data_filename, db)),
+        ('step8', lambda: step8_create_productcategory_to_productcategoryid_dictionary(db)),
+        ('step9', lambda: step9_create_product_table(data_filename, db)),
+        ('step10', lambda: step10_create_product_to_productid_dictionary(db)),
+        ('step11', lambda: step11_create_orderdetail_table(data_filename, db)),
+    ]
+    for name, run in steps:
+        # time the lookups' query rather than a cache hit
+        invalidate_lookups(db)
+        timed(name, run)
+
+    normalized = fresh(normalized_database_filename + '.normalize')
+    timed('normalize', lambda: normalize(data_filename, normalized))
+    fresh(normalized)
+
+    with connection_for(db) as conn:
+        customer_name = next(iter(step6_create_customer_to_customerid_dictionary(db, conn=conn)))
+        for name in EX_QUERIES:
+            args = (customer_name,) if name in ('ex1', 'ex2') else ()
+            timed(name, lambda: run_query(conn, name, *args))
+        timed('load_analytics_arrays', lambda: analytics_arrays(conn))
+        for name in ARRAY_QUERIES:
+            timed(name + '[numpy]', lambda: run_query(conn, name, engine='numpy'))
+        order_lines = execute_sql_statement('SELECT COUNT(*) FROM OrderDetail', conn)[0][0]
+
+    return {'data_filename': os.path.abspath(data_filename),
+            'data_bytes': os.path.getsize(data_filename),
+            'order_lines': order_lines,
+            'database_bytes': os.path.getsize(db),
+            'python': platform.python_version(),
+            'sqlite': sqlite3.sqlite_version,
+            'platform': platform.platform(),
+            'timings': timings}
+
+def benchmark_suite(sizes=(10000, 100000, 1000000), dirname='benchmark', report_filename=None, seed=0,
+                    trace_memory=False):
+    # Generates (or reuses) a synthetic extract of each size in order lines under dirname,
+    # runs run_benchmark() on it and writes all reports as one JSON list to report_filename
+    # (dirname/report.json by default), for diffing against another version's report.
+    os.makedirs(dirname, exist_ok=True)
+    reports = []
+    for size in sizes:
+        data_filename = os.path.join(dirname, 'sales_%d_%d.tsv' % (size, seed))
+        if not os.path.exists(data_filename):
+            generate_sales_data(data_filename + '.tmp', size, seed=seed)
+            os.replace(data_filename + '.tmp', data_filename)
+        report = run_benchmark(data_filename, os.path.join(dirname, 'sales_%d.db' % size), trace_memory)
+        report['size'] = size
+        reports.append(report)
+    with open(report_filename or os.path.join(dirname, 'report.json'), 'w') as f:
+        json.dump(reports, f, indent=2)
+    return reports
 
 
 def ex1(conn, CustomerName):
@@ -340,7 +2036,13 @@ def ex1(conn, CustomerName):
     # HINT: USE customer_to_customerid_dict to map customer name to customer id and then use where clause with CustomerID
     
     ### BEGIN SOLUTION
-    customers = step6_create_customer_to_customerid_dictionary('normalized.db')
+    sql_statement, params = ex1_statement(conn, CustomerName)
+    ### END SOLUTION
+    return sql_statement.replace(':CustomerID', str(int(params['CustomerID'])))
+
+def ex1_statement(conn, CustomerName):
+    # ex1's SQL with the customer id left as the :CustomerID parameter.
+    customers = step6_create_customer_to_customerid_dictionary(None, conn=conn)
     cust_id = customers[CustomerName]
     sql_statement = """
     SELECT
@@ -353,11 +2055,9 @@ def ex1(conn, CustomerName):
     FROM OrderDetail o
     JOIN Customer c ON o.CustomerID = c.CustomerID
     JOIN Product p on o.ProductID = p.ProductID
-    where c.CustomerID = {}
-    """.format(cust_id)
-    ### END SOLUTION
-    df = pd.read_sql_query(sql_statement, conn)
-    return sql_statement
+    where c.CustomerID = :CustomerID
+    """
+    return sql_statement, {'CustomerID': cust_id}
 
 def ex2(conn, CustomerName):
     
@@ -369,7 +2069,13 @@ def ex2(conn, CustomerName):
     # HINT: USE customer_to_customerid_dict to map customer name to customer id and then use where clause with CustomerID
     
     ### BEGIN SOLUTION
-    customers = step6_create_customer_to_customerid_dictionary('normalized.db')
+    sql_statement, params = ex2_statement(conn, CustomerName)
+    ### END SOLUTION
+    return sql_statement.replace(':CustomerID', str(int(params['CustomerID'])))
+
+def ex2_statement(conn, CustomerName):
+    # ex2's SQL with the customer id left as the :CustomerID parameter.
+    customers = step6_create_customer_to_customerid_dictionary(None, conn=conn)
     cust_id = customers[CustomerName]
     sql_statement = """
     SELECT
@@ -378,12 +2084,50 @@ def ex2(conn, CustomerName):
     FROM OrderDetail o
     JOIN Customer c ON o.CustomerID = c.CustomerID
     JOIN Product p on o.ProductID = p.ProductID
-    where c.CustomerID = {}
+    where c.CustomerID = :CustomerID
     GROUP BY 1
-    """.format(cust_id)
-    ### END SOLUTION
-    df = pd.read_sql_query(sql_statement, conn)
-    return sql_statement
+    """
+    return sql_statement, {'CustomerID': cust_id}
+
+def customer_ids_parameter(conn, CustomerNames):
+    # The ids of CustomerNames as one JSON array, bound as a single parameter and
+    # expanded with json_each, so the statement text does not depend on how many
+    # customers are asked for and works on read-only connections.
+    customers = step6_create_customer_to_customerid_dictionary(None, conn=conn)
+    return json.dumps([customers[name] for name in CustomerNames])
+
+def ex1_many(conn, CustomerNames):
+    # ex1 for many customers in a single query; returns the DataFrame of all their rows.
+    sql_statement = """
+    SELECT
+    c.FirstName || ' ' || c.LastName AS Name, 
+    p.ProductName,
+    o.OrderDate,
+    p.ProductUnitPrice,
+    o.QuantityOrdered,
+    ROUND(p.ProductUnitPrice * o.QuantityOrdered, 2) AS Total
+    FROM OrderDetail o
+    JOIN Customer c ON o.CustomerID = c.CustomerID
+    JOIN Product p on o.ProductID = p.ProductID
+    where c.CustomerID IN (SELECT value FROM json_each(:CustomerIDs))
+    """
+    params = {'CustomerIDs': customer_ids_parameter(conn, CustomerNames)}
+    return pd.read_sql_query(sql_statement, conn, params=params)
+
+def ex2_many(conn, CustomerNames):
+    # ex2 for many customers in a single query; returns one Name, Total row per customer.
+    sql_statement = """
+    SELECT
+    c.FirstName || ' ' || c.LastName AS Name, 
+    ROUND(SUM(p.ProductUnitPrice * o.QuantityOrdered),2) AS Total
+    FROM OrderDetail o
+    JOIN Customer c ON o.CustomerID = c.CustomerID
+    JOIN Product p on o.ProductID = p.ProductID
+    where c.CustomerID IN (SELECT value FROM json_each(:CustomerIDs))
+    GROUP BY 1
+    """
+    params = {'CustomerIDs': customer_ids_parameter(conn, CustomerNames)}
+    return pd.read_sql_query(sql_statement, conn, params=params)
 
 def ex3(conn):
     
@@ -397,15 +2141,13 @@ def ex3(conn):
     sql_statement = """
     SELECT
     c.FirstName || ' ' || c.LastName AS Name,
-    ROUND(SUM(p.ProductUnitPrice * o.QuantityOrdered),2) AS Total
-    FROM OrderDetail o
-    JOIN Customer c ON o.CustomerID = c.CustomerID
-    JOIN Product p on o.ProductID = p.ProductID
+    ROUND(SUM(t.Total),2) AS Total
+    FROM CustomerTotal t
+    JOIN Customer c ON t.CustomerID = c.CustomerID
     GROUP BY 1
     ORDER BY 2 DESC
     """
     ### END SOLUTION
-    df = pd.read_sql_query(sql_statement, conn)
     return sql_statement
 
 def ex4(conn):
@@ -422,17 +2164,13 @@ def ex4(conn):
     sql_statement = """
     SELECT
     r.Region,
-    ROUND(SUM(p.ProductUnitPrice * o.QuantityOrdered),2) AS Total
-    FROM OrderDetail o
-    JOIN Customer c ON o.CustomerID = c.CustomerID
-    JOIN Product p on o.ProductID = p.ProductID
-    JOIN Country ct on c.CountryID = ct.CountryID
-    JOIN Region r on ct.RegionID = r.RegionID
+    ROUND(SUM(t.Total),2) AS Total
+    FROM RegionTotal t
+    JOIN Region r on t.RegionID = r.RegionID
     GROUP BY 1
     ORDER BY 2 DESC
     """
     ### END SOLUTION
-    df = pd.read_sql_query(sql_statement, conn)
     return sql_statement
 
 def ex5(conn):
@@ -448,16 +2186,13 @@ def ex5(conn):
     sql_statement = """
     SELECT
     ct.Country,
-    ROUND(SUM(p.ProductUnitPrice * o.QuantityOrdered)) AS CountryTotal
-    FROM OrderDetail o
-    JOIN Customer c ON o.CustomerID = c.CustomerID
-    JOIN Product p on o.ProductID = p.ProductID
-    JOIN Country ct on c.CountryID = ct.CountryID
+    ROUND(SUM(t.Total)) AS CountryTotal
+    FROM CountryTotal t
+    JOIN Country ct on t.CountryID = ct.CountryID
     GROUP BY 1
     ORDER BY 2 DESC
     """
     ### END SOLUTION
-    df = pd.read_sql_query(sql_statement, conn)
     return sql_statement
 
 
@@ -473,18 +2208,15 @@ def ex6(conn):
     SELECT
     r.Region,
     ct.Country,
-    ROUND(SUM(p.ProductUnitPrice * o.QuantityOrdered)) AS CountryTotal,
-    rank() OVER (PARTITION BY r.Region ORDER BY ROUND(SUM(p.ProductUnitPrice * o.QuantityOrdered)) DESC) CountryRegionalRank
-    FROM OrderDetail o
-    JOIN Customer c ON o.CustomerID = c.CustomerID
-    JOIN Product p on o.ProductID = p.ProductID
-    JOIN Country ct on c.CountryID = ct.CountryID
+    ROUND(SUM(t.Total)) AS CountryTotal,
+    rank() OVER (PARTITION BY r.Region ORDER BY ROUND(SUM(t.Total)) DESC) CountryRegionalRank
+    FROM CountryTotal t
+    JOIN Country ct on t.CountryID = ct.CountryID
     JOIN Region r on ct.RegionID = r.RegionID
     GROUP BY 1,2
     ORDER BY 1 ASC
     """
     ### END SOLUTION
-    df = pd.read_sql_query(sql_statement, conn)
     return sql_statement
 
 
@@ -503,12 +2235,10 @@ def ex7(conn):
     SELECT
     r.Region,
     ct.Country,
-    ROUND(SUM(p.ProductUnitPrice * o.QuantityOrdered)) AS CountryTotal,
-    rank() OVER (PARTITION BY r.Region ORDER BY ROUND(SUM(p.ProductUnitPrice * o.QuantityOrdered)) DESC) CountryRegionalRank
-    FROM OrderDetail o
-    JOIN Customer c ON o.CustomerID = c.CustomerID
-    JOIN Product p on o.ProductID = p.ProductID
-    JOIN Country ct on c.CountryID = ct.CountryID
+    ROUND(SUM(t.Total)) AS CountryTotal,
+    rank() OVER (PARTITION BY r.Region ORDER BY ROUND(SUM(t.Total)) DESC) CountryRegionalRank
+    FROM CountryTotal t
+    JOIN Country ct on t.CountryID = ct.CountryID
     JOIN Region r on ct.RegionID = r.RegionID
     GROUP BY 1,2
     ORDER BY 1 ASC
@@ -516,7 +2246,6 @@ def ex7(conn):
     SELECT * FROM Country_ranks WHERE CountryRegionalRank = 1
     """
     ### END SOLUTION
-    df = pd.read_sql_query(sql_statement, conn)
     return sql_statement
 
 def ex8(conn):
@@ -531,20 +2260,12 @@ def ex8(conn):
     sql_statement = """
     WITH Customer_sales AS (
     SELECT 
-    CASE
-        WHEN 0 + strftime('%m', o.OrderDate) BETWEEN 1
-        AND 3 THEN 'Q1'
-        WHEN 0 + strftime('%m', o.OrderDate) BETWEEN 4
-        AND 6 THEN 'Q2'
-        WHEN 0 + strftime('%m', o.OrderDate) BETWEEN 7
-        AND 9 THEN 'Q3'
-        WHEN 0 + strftime('%m', o.OrderDate) BETWEEN 10
-        AND 12 THEN 'Q4'
-    END Quarter,
-    cast(strftime('%Y', o.OrderDate) as INT) Year,
+    d.Quarter,
+    d.Year,
     c.CustomerID,
     ROUND(SUM(p.ProductUnitPrice * o.QuantityOrdered)) as Total
     FROM OrderDetail o
+    JOIN Calendar d ON o.DateKey = d.DateKey
     JOIN Customer c ON o.CustomerID = c.CustomerID
     JOIN Product p on o.ProductID = p.ProductID
     GROUP BY 1,2,3
@@ -553,7 +2274,6 @@ def ex8(conn):
     SELECT * FROM Customer_sales
     """
     ### END SOLUTION
-    df = pd.read_sql_query(sql_statement, conn)
     return sql_statement
 
 def ex9(conn):
@@ -570,20 +2290,12 @@ def ex9(conn):
     sql_statement = """
     WITH Customer_sales AS (
     SELECT 
-    CASE
-        WHEN 0 + strftime('%m', o.OrderDate) BETWEEN 1
-        AND 3 THEN 'Q1'
-        WHEN 0 + strftime('%m', o.OrderDate) BETWEEN 4
-        AND 6 THEN 'Q2'
-        WHEN 0 + strftime('%m', o.OrderDate) BETWEEN 7
-        AND 9 THEN 'Q3'
-        WHEN 0 + strftime('%m', o.OrderDate) BETWEEN 10
-        AND 12 THEN 'Q4'
-    END Quarter,
-    cast(strftime('%Y', o.OrderDate) as INT) Year,
+    d.Quarter,
+    d.Year,
     c.CustomerID,
     ROUND(SUM(p.ProductUnitPrice * o.QuantityOrdered)) as Total
     FROM OrderDetail o
+    JOIN Calendar d ON o.DateKey = d.DateKey
     JOIN Customer c ON o.CustomerID = c.CustomerID
     JOIN Product p on o.ProductID = p.ProductID
     GROUP BY 1,2,3
@@ -598,7 +2310,6 @@ def ex9(conn):
     SELECT * FROM Customer_sales_rank WHERE CustomerRank in (1,2,3,4,5) ORDER BY Year
     """
     ### END SOLUTION
-    df = pd.read_sql_query(sql_statement, conn)
     return sql_statement
 
 def ex10(conn):
@@ -612,22 +2323,10 @@ def ex10(conn):
     sql_statement = """
     WITH Month_rank AS (
     SELECT 
-    CASE
-        WHEN strftime('%m', o.OrderDate) = '01' THEN 'January'
-        WHEN strftime('%m', o.OrderDate) = '02' THEN 'February'
-        WHEN strftime('%m', o.OrderDate) = '03' THEN 'March'
-        WHEN strftime('%m', o.OrderDate) = '04' THEN 'April'
-        WHEN strftime('%m', o.OrderDate) = '05' THEN 'May'
-        WHEN strftime('%m', o.OrderDate) = '06' THEN 'June'
-        WHEN strftime('%m', o.OrderDate) = '07' THEN 'July'
-        WHEN strftime('%m', o.OrderDate) = '08' THEN 'August'
-        WHEN strftime('%m', o.OrderDate) = '09' THEN 'September'
-        WHEN strftime('%m', o.OrderDate) = '10' THEN 'October'
-        WHEN strftime('%m', o.OrderDate) = '11' THEN 'November'
-        WHEN strftime('%m', o.OrderDate) = '12' THEN 'December'
-    END Month, 
+    d.MonthName AS Month, 
     Sum(ROUND(p.ProductUnitPrice * o.QuantityOrdered)) as Total
     FROM OrderDetail o
+    JOIN Calendar d ON o.DateKey = d.DateKey
     JOIN Product p on o.ProductID = p.ProductID
     GROUP BY 1
     )  
@@ -638,7 +2337,6 @@ def ex10(conn):
     FROM Month_rank 
     """
     ### END SOLUTION
-    df = pd.read_sql_query(sql_statement, conn)
     return sql_statement
 
 def ex11(conn):
@@ -659,34 +2357,1047 @@ def ex11(conn):
     ### BEGIN SOLUTION
 
     sql_statement = """
-    WITH orderdate AS (
-        SELECT 
-        CustomerID,
-        OrderDate,
-        LAG(OrderDate,1) OVER (PARTITION BY CustomerID ORDER BY OrderDate ASC) as PreviousOrderDate
-        FROM OrderDetail
-    ), maxdays AS (
-        SELECT 
-        CustomerID,
-        OrderDate,
-        PreviousOrderDate,
-        Max(julianday(OrderDate) - julianday(PreviousOrderDate)) as MaxDaysWithoutOrder
-        FROM orderdate
-        GROUP BY 1
-        ORDER BY 4 DESC
-    )
     SELECT
-    m.CustomerID,
+    g.CustomerID,
     c.FirstName,
     c.LastName,
     ct.Country,
-    m.OrderDate,
-    m.PreviousOrderDate,
-    m.MaxDaysWithoutOrder
-    FROM maxdays m
-    JOIN Customer c on m.CustomerID = c.CustomerID
+    g.OrderDate,
+    g.PreviousOrderDate,
+    g.MaxDaysWithoutOrder
+    FROM CustomerGap g
+    JOIN Customer c on g.CustomerID = c.CustomerID
     JOIN Country ct on c.CountryID = ct.CountryID
+    ORDER BY g.MaxDaysWithoutOrder DESC
     """
     ### END SOLUTION
-    df = pd.read_sql_query(sql_statement, conn)
-    return sql_statement
\ No newline at end of file
+    return sql_statement
+
+EX_QUERIES = {
+    'ex1': ex1_statement,
+    'ex2': ex2_statement,
+    'ex3': ex3,
+    'ex4': ex4,
+    'ex5': ex5,
+    'ex6': ex6,
+    'ex7': ex7,
+    'ex8': ex8,
+    'ex9': ex9,
+    'ex10': ex10,
+    'ex11': ex11,
+}
+
+RESULT_FORMATS = ('dataframe', 'tuples', 'columns', 'cursor')
+
+def ex_statement(conn, name, *args):
+    # The SQL of ex query `name` and its bound parameters, without running it.
+    statement = EX_QUERIES[name](conn, *args)
+    if isinstance(statement, tuple):
+        return statement
+    return statement, {}
+
+def run_query(conn, name, *args, result_format='dataframe', engine='sql'):
+    # Runs ex query `name` once and returns its result as
+    #   'dataframe' - a pandas DataFrame
+    #   'tuples'    - a list of row tuples
+    #   'columns'   - a dict of column name -> list of values
+    #   'cursor'    - the executed cursor, to stream large results such as ex8 row by row
+    # engine='numpy' computes ex3 - ex11 from analytics_arrays() instead of SQLite.
+    with trace('%s.%s' % (name, engine)) as record:
+        result = _run_query(conn, name, *args, result_format=result_format, engine=engine)
+        if result_format == 'columns':
+            record['rows_read'] = len(next(iter(result.values()), []))
+        elif result_format != 'cursor':
+            record['rows_read'] = len(result)
+        return result
+
+def _run_query(conn, name, *args, result_format='dataframe', engine='sql'):
+    if result_format not in RESULT_FORMATS:
+        raise ValueError('result_format must be one of %s, not %r' % (', '.join(RESULT_FORMATS), result_format))
+    if engine not in ENGINES:
+        raise ValueError('engine must be one of %s, not %r' % (', '.join(ENGINES), engine))
+    if engine == 'numpy':
+        if name not in ARRAY_QUERIES:
+            raise ValueError('the numpy engine has no %s' % name)
+        if result_format == 'cursor':
+            raise ValueError("the numpy engine cannot return a 'cursor'")
+        df = ARRAY_QUERIES[name](analytics_arrays(conn), *args)
+        if result_format == 'dataframe':
+            return df
+        if result_format == 'tuples':
+            return list(df.itertuples(index=False, name=None))
+        return {column: df[column].tolist() for column in df}
+    sql_statement, params = ex_statement(conn, name, *args)
+    if result_format == 'dataframe':
+        return pd.read_sql_query(sql_statement, conn, params=params)
+    cur = conn.cursor()
+    cur.execute(sql_statement, params)
+    if result_format == 'cursor':
+        return cur
+    rows = cur.fetchall()
+    if result_format == 'tuples':
+        return rows
+    names = [column[0] for column in cur.description]
+    columns = [list(column) for column in zip(*rows)] or [[] for name in names]
+    return dict(zip(names, columns))
+
+class ResultCache:
+    # Results of run_query() keyed by database, DataVersion token, query, arguments,
+    # result format and engine. Up to max_entries results are kept in memory, least
+    # recently used first out. With cache_dirname, results are also pickled there (at most
+    # max_disk_entries files, oldest first out) so other processes and later runs reuse
+    # them. Callers get copies and cannot change the cached results.
+
+    def __init__(self, max_entries=64, cache_dirname=None, max_disk_entries=1024):
+        self.max_entries = max_entries
+        self.cache_dirname = cache_dirname
+        self.max_disk_entries = max_disk_entries
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        if cache_dirname:
+            os.makedirs(cache_dirname, exist_ok=True)
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'disk_hits': self.disk_hits, 'misses': self.misses,
+                    'entries': len(self._entries)}
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+        if self.cache_dirname:
+            for filename in os.listdir(self.cache_dirname):
+                if filename.endswith('.pkl'):
+                    os.remove(os.path.join(self.cache_dirname, filename))
+
+    def _path(self, key):
+        return os.path.join(self.cache_dirname, hashlib.sha256(repr(key).encode('utf-8')).hexdigest() + '.pkl')
+
+    def get(self, key):
+        # (True, copy of the result) or (False, None)
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return True, copy_result(self._entries[key])
+        if self.cache_dirname:
+            try:
+                with open(self._path(key), 'rb') as f:
+                    result = pickle.load(f)
+            except (OSError, pickle.UnpicklingError, EOFError):
+                pass
+            else:
+                self._remember(key, result)
+                with self._lock:
+                    self.disk_hits += 1
+                return True, copy_result(result)
+        with self._lock:
+            self.misses += 1
+        return False, None
+
+    def put(self, key, result):
+        # Stores result and returns a copy of it for the caller.
+        self._remember(key, result)
+        if self.cache_dirname:
+            path = self._path(key)
+            with open(path + '.tmp', 'wb') as f:
+                pickle.dump(result, f, pickle.HIGHEST_PROTOCOL)
+            os.replace(path + '.tmp', path)
+            self._prune_disk()
+        return copy_result(result)
+
+    def _remember(self, key, result):
+        with self._lock:
+            self._entries[key] = result
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def _prune_disk(self):
+        paths = [os.path.join(self.cache_dirname, filename) for filename in os.listdir(self.cache_dirname)
+                 if filename.endswith('.pkl')]
+        if len(paths) > self.max_disk_entries:
+            paths.sort(key=os.path.getmtime)
+            for path in paths[:len(paths) - self.max_disk_entries]:
+                os.remove(path)
+
+def copy_result(result):
+    if isinstance(result, dict):
+        return {name: list(values) for name, values in result.items()}
+    if isinstance(result, list):
+        return list(result)
+    # a deep copy: before pandas' copy-on-write, a shallow copy shares the cached values
+    return result.copy(deep=True)
+
+def cached_run_query(cache, conn, name, *args, result_format='dataframe', engine='sql'):
+    # run_query() through cache. Results of unversioned or in-memory databases and
+    # cursors are not cached.
+    key = database_key(None, conn)
+    version = data_version(conn)
+    if key is None or version is None or result_format == 'cursor':
+        return run_query(conn, name, *args, result_format=result_format, engine=engine)
+    key = (key, version, name, args, result_format, engine)
+    found, result = cache.get(key)
+    if found:
+        return result
+    return cache.put(key, run_query(conn, name, *args, result_format=result_format, engine=engine))
+
+def query_plan_report(conn, CustomerName):
+    # EXPLAIN QUERY PLAN of every ex query as {'ex1': [plan lines], ...}, for checking
+    # which of the TABLE_INDEX_SQL indexes each query picks up.
+    report = {}
+    for name in EX_QUERIES:
+        args = (CustomerName,) if name in ('ex1', 'ex2') else ()
+        sql_statement, params = ex_statement(conn, name, *args)
+        plan = conn.execute('EXPLAIN QUERY PLAN ' + sql_statement, params).fetchall()
+        report[name] = [row[3] for row in plan]
+    return report
+
+
+# Top-K per group for the "top N" reports. Ranking every row with rank() only to keep the
+# first few sorts the whole aggregate; top_k_per_group() makes one pass over it with a
+# bounded heap per group instead, so memory grows with k x groups, not with the rows.
+# top_k() aggregates OrderDetail by any of TOP_K_GROUPS, TOP_K_ENTITIES and TOP_K_MEASURES
+# and keeps the top k of each group.
+TOP_K_GROUPS = {
+    None: (),
+    'region': ('r.Region',),
+    'country': ('ct.Country',),
+    'year': ('d.Year',),
+    'quarter': ('d.Quarter', 'd.Year'),
+    'month': ('d.Year', 'd.Month'),
+}
+
+TOP_K_ENTITIES = {
+    'customer': 'o.CustomerID',
+    'country': 'ct.Country',
+    'product': 'p.ProductName',
+}
+
+TOP_K_MEASURES = {
+    'sales': 'ROUND(SUM(p.ProductUnitPrice * o.QuantityOrdered)) AS Total',
+    'quantity': 'SUM(o.QuantityOrdered) AS Quantity',
+}
+
+# each join with the table aliases that need it
+TOP_K_JOINS = [
+    (('p',), 'JOIN Product p ON o.ProductID = p.ProductID'),
+    (('c', 'ct', 'r'), 'JOIN Customer c ON o.CustomerID = c.CustomerID'),
+    (('ct', 'r'), 'JOIN Country ct ON c.CountryID = ct.CountryID'),
+    (('r',), 'JOIN Region r ON ct.RegionID = r.RegionID'),
+    (('d',), 'JOIN Calendar d ON o.DateKey = d.DateKey'),
+]
+
+def top_k_per_group(rows, k, group=None, measure=operator.itemgetter(-1)):
+    # The rows ranked 1 - k by measure (highest first) within their group as (rank, row)
+    # pairs, ordered by group in order of first appearance, then by rank, then by input
+    # order. Ranks are SQL rank()'s: tied rows share a rank and the next rank skips past
+    # them, so a group returns more than k rows when rows tie at rank k.
+    if k < 1:
+        raise ValueError('k must be at least 1, not %r' % (k,))
+    heaps = {}
+    for sequence, row in enumerate(rows):
+        heap = heaps.setdefault(group(row) if group else None, [])
+        value = measure(row)
+        if len(heap) >= k and value < heap[0][0]:
+            # k kept rows are larger, so this one ranks below k
+            continue
+        heapq.heappush(heap, (value, sequence, row))
+        while len(heap) > k:
+            # drop the lowest value with its ties once k rows outrank them
+            lowest = heap[0][0]
+            ties = []
+            while heap and heap[0][0] == lowest:
+                ties.append(heapq.heappop(heap))
+            if len(heap) < k:
+                for tie in ties:
+                    heapq.heappush(heap, tie)
+                break
+    ranked = []
+    for heap in heaps.values():
+        heap.sort(key=lambda entry: (-entry[0], entry[1]))
+        rank = 0
+        for position, (value, sequence, row) in enumerate(heap):
+            if position == 0 or value != heap[position - 1][0]:
+                rank = position + 1
+            ranked.append((rank, row))
+    return ranked
+
+def top_k_statement(group_by='quarter', entity='customer', measure='sales'):
+    # The aggregate top_k() ranks: the group columns, the entity and the measure, last.
+    for argument, value, choices in (('group_by', group_by, TOP_K_GROUPS), ('entity', entity, TOP_K_ENTITIES),
+                                     ('measure', measure, TOP_K_MEASURES)):
+        if value not in choices:
+            raise ValueError('%s must be one of %s, not %r' % (argument, ', '.join(map(str, choices)), value))
+    return aggregate_statement(list(TOP_K_GROUPS[group_by]) + [TOP_K_ENTITIES[entity], TOP_K_MEASURES[measure]])
+
+def aggregate_statement(columns):
+    # SELECT columns FROM OrderDetail o with the TOP_K_JOINS their table aliases need,
+    # grouped by every column but the last, the aggregate.
+    select = ',\n    '.join(columns)
+    joins = [join for aliases, join in TOP_K_JOINS
+             if any(re.search(r'\b%s\.' % alias, select) for alias in aliases)]
+    return '''
+    SELECT
+    %s
+    FROM OrderDetail o
+    %s
+    GROUP BY %s
+    ''' % (select, '\n    '.join(joins), ', '.join(str(i) for i in range(1, len(columns))))
+
+def top_k(conn, k=5, group_by='quarter', entity='customer', measure='sales'):
+    # DataFrame of the top k entities of every group by measure, with their rank() in a
+    # Rank column. top_k(conn, 5) gives ex9's rows; top_k(conn, 1, 'region', 'country')
+    # gives ex7's.
+    group_columns = len(TOP_K_GROUPS.get(group_by, ()))
+    with trace('top_k') as record:
+        cur = conn.execute(top_k_statement(group_by, entity, measure))
+        names = [column[0] for column in cur.description]
+        ranked = top_k_per_group(cur, k, group=operator.itemgetter(*range(group_columns)) if group_columns else None)
+        record['rows_read'] = len(ranked)
+    return pd.DataFrame([row + (rank,) for rank, row in ranked], columns=names + ['Rank'])
+
+def benchmark_top_k(conn, repeat=3):
+    # Best wall time in seconds of ex7 and ex9 with their rank() windows against the
+    # same rows from top_k().
+    return {'ex7': best_time(lambda: run_query(conn, 'ex7'), repeat),
+            'top_k_ex7': best_time(lambda: top_k(conn, 1, 'region', 'country'), repeat),
+            'ex9': best_time(lambda: run_query(conn, 'ex9'), repeat),
+            'top_k_ex9': best_time(lambda: top_k(conn, 5), repeat)}
+
+# In-memory NumPy engine for ex3 - ex11, selected with run_query(..., engine='numpy').
+# load_analytics_arrays() reads OrderDetail once into int32 columns and the dimension
+# tables into arrays indexed by id; the array_exN functions then compute the same
+# result frames as the SQL with bincount / unique / groupby instead of joins. Loaded
+# arrays are kept per database until one of the tables they come from grows or the
+# database is rebuilt (invalidate_lookups() with no table), for at most LOOKUP_CACHE_SIZE
+# databases, least recently used first out.
+ENGINES = ('sql', 'numpy')
+
+_analytics_cache = collections.OrderedDict()
+
+def by_id(df, id_column, column):
+    # df[column] as an array indexed by df[id_column]; ids without a row hold 0 or ''.
+    ids = df[id_column].to_numpy()
+    values = df[column].to_numpy()
+    result = np.full(ids.max() + 1 if len(ids) else 0, '' if values.dtype == object else 0, dtype=values.dtype)
+    result[ids] = values
+    return result
+
+def load_analytics_arrays(conn):
+    orders = pd.read_sql_query('SELECT CustomerID, ProductID, DateKey, QuantityOrdered FROM OrderDetail ORDER BY OrderID', conn)
+    customer = pd.read_sql_query('SELECT CustomerID, FirstName, LastName, CountryID FROM Customer', conn)
+    product = pd.read_sql_query('SELECT ProductID, ProductUnitPrice FROM Product', conn)
+    country = pd.read_sql_query('SELECT CountryID, Country, RegionID FROM Country', conn)
+    region = pd.read_sql_query('SELECT RegionID, Region FROM Region', conn)
+    calendar = pd.read_sql_query('SELECT DateKey, OrderDate, Year, Quarter, MonthName FROM Calendar ORDER BY DateKey', conn)
+
+    arrays = {name: orders[name].to_numpy(np.int32) for name in ('CustomerID', 'ProductID', 'DateKey', 'QuantityOrdered')}
+    arrays['Amount'] = by_id(product, 'ProductID', 'ProductUnitPrice')[arrays['ProductID']] * arrays['QuantityOrdered']
+    # position of each order's date in the Calendar arrays
+    arrays['DateIndex'] = np.searchsorted(calendar['DateKey'].to_numpy(), arrays['DateKey']).astype(np.int32)
+    arrays['FirstName'] = by_id(customer, 'CustomerID', 'FirstName')
+    arrays['LastName'] = by_id(customer, 'CustomerID', 'LastName')
+    arrays['CustomerName'] = arrays['FirstName'] + ' ' + arrays['LastName']
+    arrays['CustomerCountry'] = by_id(customer, 'CustomerID', 'CountryID')
+    arrays['CountryName'] = by_id(country, 'CountryID', 'Country')
+    arrays['CountryRegion'] = by_id(country, 'CountryID', 'RegionID')
+    arrays['RegionName'] = by_id(region, 'RegionID', 'Region')
+    for name in ('OrderDate', 'Year', 'Quarter', 'MonthName'):
+        arrays['Calendar' + name] = calendar[name].to_numpy()
+    arrays['CalendarDay'] = (pd.to_datetime(calendar['OrderDate']).to_numpy() - np.datetime64('1970-01-01', 'D')) // np.timedelta64(1, 'D')
+    return arrays
+
+def analytics_arrays(conn):
+    # load_analytics_arrays() of the database behind conn, reused while its DataVersion
+    # holds, so rebuilds and loads by another process are picked up as well. Arrays of
+    # unversioned or in-memory databases are not cached.
+    key = database_key(None, conn)
+    version = data_version(conn)
+    if key is None or version is None:
+        return load_analytics_arrays(conn)
+    with _lookup_cache_lock:
+        cached = _analytics_cache.get(key)
+        if cached is not None and cached[0] == version:
+            _analytics_cache.move_to_end(key)
+            return cached[1]
+    arrays = load_analytics_arrays(conn)
+    with _lookup_cache_lock:
+        _analytics_cache[key] = (version, arrays)
+        _analytics_cache.move_to_end(key)
+        while len(_analytics_cache) > LOOKUP_CACHE_SIZE:
+            _analytics_cache.popitem(last=False)
+    return arrays
+
+def sqlite_round(values, digits=0):
+    # ROUND() as SQLite does it, halves away from zero rather than numpy's to-even.
+    scale = 10.0 ** digits
+    return np.trunc(np.asarray(values) * scale + np.copysign(0.5, values)) / scale
+
+def group_sums(keys, weights):
+    # (distinct keys, sum of weights per key) with the keys in ascending order.
+    groups, inverse = np.unique(keys, return_inverse=True)
+    return groups, np.bincount(inverse, weights=weights, minlength=len(groups))
+
+def array_ex3(arrays):
+    customers, totals = group_sums(arrays['CustomerID'], arrays['Amount'])
+    df = pd.DataFrame({'Name': arrays['CustomerName'][customers], 'Total': totals})
+    df = df.groupby('Name', as_index=False, sort=False)['Total'].sum()
+    df['Total'] = sqlite_round(df['Total'], 2)
+    return df.sort_values('Total', ascending=False, kind='stable', ignore_index=True)
+
+def array_ex4(arrays):
+    regions, totals = group_sums(arrays['CountryRegion'][arrays['CustomerCountry'][arrays['CustomerID']]], arrays['Amount'])
+    df = pd.DataFrame({'Region': arrays['RegionName'][regions], 'Total': sqlite_round(totals, 2)})
+    return df.sort_values('Total', ascending=False, kind='stable', ignore_index=True)
+
+def country_totals(arrays):
+    countries, totals = group_sums(arrays['CustomerCountry'][arrays['CustomerID']], arrays['Amount'])
+    return pd.DataFrame({'Region': arrays['RegionName'][arrays['CountryRegion'][countries]],
+                         'Country': arrays['CountryName'][countries],
+                         'CountryTotal': sqlite_round(totals)})
+
+def array_ex5(arrays):
+    df = country_totals(arrays)[['Country', 'CountryTotal']]
+    return df.sort_values('CountryTotal', ascending=False, kind='stable', ignore_index=True)
+
+def array_ex6(arrays):
+    df = country_totals(arrays)
+    df['CountryRegionalRank'] = df.groupby('Region')['CountryTotal'].rank(method='min', ascending=False).astype(np.int64)
+    return df.sort_values(['Region', 'CountryRegionalRank'], kind='stable', ignore_index=True)
+
+def array_ex7(arrays):
+    df = array_ex6(arrays)
+    return df[df['CountryRegionalRank'] == 1].reset_index(drop=True)
+
+def customer_quarter_sales(arrays):
+    # ex8: rounded sales per (Quarter, Year, CustomerID), as ints packed into one key
+    quarters = np.char.lstrip(arrays['CalendarQuarter'].astype(str), 'Q').astype(np.int64)
+    periods = arrays['CalendarYear'].astype(np.int64) * 4 + quarters - 1
+    customer_count = np.int64(arrays['CustomerID'].max()) + 1 if len(arrays['CustomerID']) else 1
+    keys, totals = group_sums(periods[arrays['DateIndex']] * customer_count + arrays['CustomerID'], arrays['Amount'])
+    periods, customers = np.divmod(keys, customer_count)
+    return pd.DataFrame({'Quarter': ['Q%d' % q for q in periods % 4 + 1],
+                         'Year': periods // 4,
+                         'CustomerID': customers,
+                         'Total': sqlite_round(totals)})
+
+def array_ex8(arrays):
+    return customer_quarter_sales(arrays).sort_values('Year', kind='stable', ignore_index=True)
+
+def array_ex9(arrays):
+    df = customer_quarter_sales(arrays)
+    df['CustomerRank'] = df.groupby(['Quarter', 'Year'])['Total'].rank(method='min', ascending=False).astype(np.int64)
+    df = df[df['CustomerRank'] <= 5]
+    return df.sort_values(['Year', 'Quarter', 'CustomerRank'], kind='stable', ignore_index=True)
+
+def array_ex10(arrays):
+    # per-day sums first, so only the few thousand calendar days are grouped by month name
+    day_count = len(arrays['CalendarMonthName'])
+    daily = np.bincount(arrays['DateIndex'], weights=sqlite_round(arrays['Amount']), minlength=day_count)
+    ordered = np.bincount(arrays['DateIndex'], minlength=day_count) > 0
+    months, totals = group_sums(arrays['CalendarMonthName'][ordered], daily[ordered])
+    df = pd.DataFrame({'Month': months, 'Total': totals})
+    df['TotalRank'] = df['Total'].rank(method='min', ascending=False).astype(np.int64)
+    return df.sort_values('TotalRank', kind='stable', ignore_index=True)
+
+def group_starts(keys):
+    # True where a run of equal keys starts
+    starts = np.ones(len(keys), dtype=bool)
+    starts[1:] = keys[1:] != keys[:-1]
+    return starts
+
+def array_ex11(arrays):
+    # LAG over each customer's orders by date, then the earliest of the largest gaps per
+    # customer, the row SQLite's bare columns next to MAX() come from
+    order = np.lexsort((arrays['DateKey'], arrays['CustomerID']))
+    customers = arrays['CustomerID'][order]
+    dates = arrays['DateIndex'][order]
+    first = group_starts(customers)
+    previous = np.roll(dates, 1)
+    days = arrays['CalendarDay']
+    gaps = np.where(first, -1, days[dates] - days[previous])
+    by_gap = np.lexsort((-gaps, customers))
+    best = by_gap[group_starts(customers[by_gap])]
+    customer_ids = customers[best]
+    has_gap = gaps[best] >= 0
+    df = pd.DataFrame({'CustomerID': customer_ids.astype(np.int64),
+                       'FirstName': arrays['FirstName'][customer_ids],
+                       'LastName': arrays['LastName'][customer_ids],
+                       'Country': arrays['CountryName'][arrays['CustomerCountry'][customer_ids]],
+                       'OrderDate': arrays['CalendarOrderDate'][dates[best]],
+                       'PreviousOrderDate': np.where(has_gap, arrays['CalendarOrderDate'][previous[best]], None),
+                       'MaxDaysWithoutOrder': np.where(has_gap, gaps[best], np.nan).astype(np.float64)})
+    return df.sort_values('MaxDaysWithoutOrder', ascending=False, kind='stable', ignore_index=True)
+
+ARRAY_QUERIES = {
+    'ex3': array_ex3,
+    'ex4': array_ex4,
+    'ex5': array_ex5,
+    'ex6': array_ex6,
+    'ex7': array_ex7,
+    'ex8': array_ex8,
+    'ex9': array_ex9,
+    'ex10': array_ex10,
+    'ex11': array_ex11,
+}
+
+def check_engine_parity(conn, names=None):
+    # {name: True/False} for whether the numpy engine returns the same rows as the SQL,
+    # compared as sets of rows (ties may come out in either order) with totals allowed
+    # to differ by a rounding step from summing in a different order.
+    arrays = analytics_arrays(conn)
+    parity = {}
+    for name in names or ARRAY_QUERIES:
+        expected = run_query(conn, name)
+        actual = ARRAY_QUERIES[name](arrays)
+        if list(expected.columns) != list(actual.columns) or len(expected) != len(actual):
+            parity[name] = False
+            continue
+        numeric = [column for column in expected if pd.api.types.is_float_dtype(expected[column])]
+        keys = [column for column in expected if column not in numeric]
+        expected = expected.sort_values(keys + numeric, ignore_index=True)
+        actual = actual.sort_values(keys + numeric, ignore_index=True)
+        parity[name] = all(expected[column].astype(str).equals(actual[column].astype(str)) for column in keys) and \
+            all(np.allclose(expected[column], actual[column], rtol=0, atol=0.01, equal_nan=True) for column in numeric)
+    return parity
+
+def benchmark_engines(conn, names=None, repeat=3):
+    # Best wall time in seconds of each ex query per engine, plus the one-off cost of
+    # loading the arrays, as {'load_arrays': t, 'ex3': {'sql': t, 'numpy': t}, ...}.
+    start = time.perf_counter()
+    arrays = load_analytics_arrays(conn)
+    timings = {'load_arrays': time.perf_counter() - start}
+    for name in names or ARRAY_QUERIES:
+        timings[name] = {'sql': best_time(lambda: run_query(conn, name), repeat),
+                         'numpy': best_time(lambda: ARRAY_QUERIES[name](arrays), repeat)}
+    return timings
+
+
+# Columnar export of the normalized tables for analytics outside SQLite. Each table is
+# written to <export_dirname>/<Table>/ with one .npy file per column: integer and real
+# columns as typed arrays, text columns dictionary-encoded as <Column>.codes.npy (int32
+# positions) and <Column>.dictionary.npy (the sorted distinct values). schema.json lists
+# the tables, their row counts and how each column is stored. SalesFact is OrderDetail
+# already joined to its customer, country, region, product, category and calendar rows.
+EXPORT_TABLES = ['Region', 'Country', 'Customer', 'ProductCategory', 'Product', 'OrderDetail']
+
+SALES_FACT_SQL = """
+    SELECT o.OrderID, o.DateKey, o.OrderDate, d.Year, d.Quarter, d.Month,
+    o.CustomerID, c.FirstName || ' ' || c.LastName AS CustomerName,
+    ct.Country, r.Region, o.ProductID, p.ProductName, pc.ProductCategory,
+    p.ProductUnitPrice, o.QuantityOrdered, p.ProductUnitPrice * o.QuantityOrdered AS Total
+    FROM OrderDetail o
+    JOIN Customer c ON o.CustomerID = c.CustomerID
+    JOIN Country ct ON c.CountryID = ct.CountryID
+    JOIN Region r ON ct.RegionID = r.RegionID
+    JOIN Product p ON o.ProductID = p.ProductID
+    JOIN ProductCategory pc ON p.ProductCategoryID = pc.ProductCategoryID
+    JOIN Calendar d ON o.DateKey = d.DateKey
+    ORDER BY o.OrderID
+"""
+
+def write_columns(table_dirname, df):
+    # Writes the columns of df as .npy files and returns their schema entries.
+    os.makedirs(table_dirname, exist_ok=True)
+    schema = {}
+    for name, column in df.items():
+        if pd.api.types.is_integer_dtype(column) or pd.api.types.is_float_dtype(column):
+            values = column.to_numpy()
+            if pd.api.types.is_integer_dtype(column) and len(values) and \
+                    np.iinfo(np.int32).min <= values.min() and values.max() <= np.iinfo(np.int32).max:
+                values = values.astype(np.int32)
+            np.save(os.path.join(table_dirname, name + '.npy'), values)
+            schema[name] = str(values.dtype)
+        else:
+            codes, dictionary = pd.factorize(column.astype(str), sort=True)
+            np.save(os.path.join(table_dirname, name + '.codes.npy'), codes.astype(np.int32))
+            np.save(os.path.join(table_dirname, name + '.dictionary.npy'), np.asarray(dictionary, dtype=str))
+            schema[name] = 'dictionary'
+    return schema
+
+def export_columnar(normalized_database_filename, export_dirname, conn=None):
+    # Inputs: Name of the normalized database and the directory to export into
+    # Output: The schema written to schema.json
+    schema = {}
+    with connection_for(normalized_database_filename, conn) as conn:
+        queries = [(table, 'SELECT * FROM %s' % table) for table in EXPORT_TABLES]
+        queries.append(('SalesFact', SALES_FACT_SQL))
+        for table, sql_statement in queries:
+            df = pd.read_sql_query(sql_statement, conn)
+            schema[table] = {'rows': len(df), 'columns': write_columns(os.path.join(export_dirname, table), df)}
+            df = None
+    with open(os.path.join(export_dirname, 'schema.json'), 'w') as f:
+        json.dump(schema, f, indent=2)
+    return schema
+
+def read_columnar(export_dirname, table, columns=None):
+    # Loads the given columns (all by default) of an exported table as a DataFrame.
+    # Numeric columns and dictionary codes are memory-mapped rather than read, and text
+    # columns come back as pandas Categoricals over the stored dictionary.
+    with open(os.path.join(export_dirname, 'schema.json')) as f:
+        table_schema = json.load(f)[table]['columns']
+    table_dirname = os.path.join(export_dirname, table)
+    data = {}
+    for name in columns or table_schema:
+        if table_schema[name] == 'dictionary':
+            codes = np.load(os.path.join(table_dirname, name + '.codes.npy'), mmap_mode='r')
+            dictionary = np.load(os.path.join(table_dirname, name + '.dictionary.npy'))
+            data[name] = pd.Categorical.from_codes(codes, dictionary, validate=False)
+        else:
+            data[name] = np.load(os.path.join(table_dirname, name + '.npy'), mmap_mode='r')
+    return pd.DataFrame(data, copy=False)
+
+
+class NormalizedDatabase:
+    # A session over one normalized database. The build steps and the ex queries share
+    # self.conn instead of opening a connection per call. With pool_size > 0 the ex
+    # queries borrow one of up to pool_size read-only connections instead, so several
+    # threads can run analytics against a file database at the same time. run_query()
+    # goes through result_cache, a ResultCache, when one is given.
+
+    def __init__(self, normalized_database_filename, delete_db=False, pool_size=0, result_cache=None):
+        self.filename = normalized_database_filename
+        self.conn = create_connection(normalized_database_filename, delete_db)
+        self.pool_size = pool_size
+        self.result_cache = result_cache
+        self._pool = queue.LifoQueue()
+        self._readers = []
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        with self._lock:
+            for conn in self._readers:
+                conn.close()
+            self._readers = []
+            self._pool = queue.LifoQueue()
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+    def _open_reader(self):
+        uri = 'file:%s?mode=ro' % urllib.request.pathname2url(os.path.abspath(self.filename))
+        conn = sqlite3.connect(uri, uri=True, check_same_thread=False)
+        conn.execute('PRAGMA query_only = 1')
+        return conn
+
+    @contextlib.contextmanager
+    def read_connection(self):
+        if not self.pool_size:
+            yield self.conn
+            return
+        try:
+            conn = self._pool.get_nowait()
+        except queue.Empty:
+            with self._lock:
+                conn = None
+                if len(self._readers) < self.pool_size:
+                    conn = self._open_reader()
+                    self._readers.append(conn)
+            if conn is None:
+                conn = self._pool.get()
+        try:
+            yield conn
+        finally:
+            self._pool.put(conn)
+
+    def normalize(self, data_filename, chunk_size=100000, bulk_load=False):
+        normalize(data_filename, self.filename, chunk_size, conn=self.conn, bulk_load=bulk_load)
+
+    def normalize_parallel(self, data_filename, workers=None, chunk_size=100000, bulk_load=False):
+        normalize_parallel(data_filename, self.filename, workers, chunk_size, conn=self.conn, bulk_load=bulk_load)
+
+    def append(self, data_filename, chunk_size=100000):
+        return append(data_filename, self.filename, chunk_size, conn=self.conn)
+
+    def bulk_load_settings(self):
+        return bulk_load_settings(self.conn)
+
+    def step1_create_region_table(self, data_filename):
+        step1_create_region_table(data_filename, self.filename, conn=self.conn)
+
+    def step2_create_region_to_regionid_dictionary(self):
+        return step2_create_region_to_regionid_dictionary(self.filename, conn=self.conn)
+
+    def step3_create_country_table(self, data_filename):
+        step3_create_country_table(data_filename, self.filename, conn=self.conn)
+
+    def step4_create_country_to_countryid_dictionary(self):
+        return step4_create_country_to_countryid_dictionary(self.filename, conn=self.conn)
+
+    def step5_create_customer_table(self, data_filename):
+        step5_create_customer_table(data_filename, self.filename, conn=self.conn)
+
+    def step6_create_customer_to_customerid_dictionary(self):
+        return step6_create_customer_to_customerid_dictionary(self.filename, conn=self.conn)
+
+    def step7_create_productcategory_table(self, data_filename):
+        step7_create_productcategory_table(data_filename, self.filename, conn=self.conn)
+
+    def step8_create_productcategory_to_productcategoryid_dictionary(self):
+        return step8_create_productcategory_to_productcategoryid_dictionary(self.filename, conn=self.conn)
+
+    def step9_create_product_table(self, data_filename):
+        step9_create_product_table(data_filename, self.filename, conn=self.conn)
+
+    def step10_create_product_to_productid_dictionary(self):
+        return step10_create_product_to_productid_dictionary(self.filename, conn=self.conn)
+
+    def step11_create_orderdetail_table(self, data_filename, chunk_size=100000):
+        step11_create_orderdetail_table(data_filename, self.filename, chunk_size, conn=self.conn)
+
+    def ex_statement(self, name, *args):
+        with self.read_connection() as conn:
+            return ex_statement(conn, name, *args)
+
+    def run_query(self, name, *args, result_format='dataframe', engine='sql'):
+        if result_format == 'cursor' and engine == 'sql':
+            return self._stream_query(name, args)
+        with self.read_connection() as conn:
+            if self.result_cache is not None:
+                return cached_run_query(self.result_cache, conn, name, *args, result_format=result_format, engine=engine)
+            return run_query(conn, name, *args, result_format=result_format, engine=engine)
+
+    def _stream_query(self, name, args):
+        # Holds on to the borrowed connection until the rows have been consumed.
+        with self.read_connection() as conn:
+            yield from run_query(conn, name, *args, result_format='cursor')
+
+    def persist_lookups(self):
+        return persist_lookups(self.filename, conn=self.conn)
+
+    def top_k(self, k=5, group_by='quarter', entity='customer', measure='sales'):
+        with self.read_connection() as conn:
+            return top_k(conn, k, group_by, entity, measure)
+
+    def export_columnar(self, export_dirname):
+        with self.read_connection() as conn:
+            return export_columnar(self.filename, export_dirname, conn=conn)
+
+    def refresh_totals(self):
+        refresh_totals(self.conn)
+
+    def refresh_customer_gaps(self):
+        refresh_customer_gaps(self.conn)
+
+    def refresh_calendar(self):
+        refresh_calendar(self.conn)
+
+    def query_plan_report(self, CustomerName):
+        with self.read_connection() as conn:
+            return query_plan_report(conn, CustomerName)
+
+    def check_engine_parity(self, names=None):
+        with self.read_connection() as conn:
+            return check_engine_parity(conn, names)
+
+    def benchmark_engines(self, names=None, repeat=3):
+        with self.read_connection() as conn:
+            return benchmark_engines(conn, names, repeat)
+
+    def ex1(self, CustomerName):
+        with self.read_connection() as conn:
+            return ex1(conn, CustomerName)
+
+    def ex2(self, CustomerName):
+        with self.read_connection() as conn:
+            return ex2(conn, CustomerName)
+
+    def ex1_many(self, CustomerNames):
+        with self.read_connection() as conn:
+            return ex1_many(conn, CustomerNames)
+
+    def ex2_many(self, CustomerNames):
+        with self.read_connection() as conn:
+            return ex2_many(conn, CustomerNames)
+
+    def ex3(self):
+        with self.read_connection() as conn:
+            return ex3(conn)
+
+    def ex4(self):
+        with self.read_connection() as conn:
+            return ex4(conn)
+
+    def ex5(self):
+        with self.read_connection() as conn:
+            return ex5(conn)
+
+    def ex6(self):
+        with self.read_connection() as conn:
+            return ex6(conn)
+
+    def ex7(self):
+        with self.read_connection() as conn:
+            return ex7(conn)
+
+    def ex8(self):
+        with self.read_connection() as conn:
+            return ex8(conn)
+
+    def ex9(self):
+        with self.read_connection() as conn:
+            return ex9(conn)
+
+    def ex10(self):
+        with self.read_connection() as conn:
+            return ex10(conn)
+
+    def ex11(self):
+        with self.read_connection() as conn:
+            return ex11(conn)
+
+
+class ShardedDatabase(NormalizedDatabase):
+    # NormalizedDatabase over a normalize_sharded() database. Its connection and pooled
+    # readers attach the shards, so the ex queries read OrderDetail through the temp view.
+
+    def __init__(self, normalized_database_filename, pool_size=0, result_cache=None):
+        super().__init__(normalized_database_filename, pool_size=pool_size, result_cache=result_cache)
+        attach_shards(self.conn)
+
+    def _open_reader(self):
+        uri = 'file:%s?mode=ro' % urllib.request.pathname2url(os.path.abspath(self.filename))
+        conn = sqlite3.connect(uri, uri=True, check_same_thread=False)
+        attach_shards(conn, read_only=True)
+        conn.execute('PRAGMA query_only = 1')
+        return conn
+
+    def fanout_aggregate(self, group_by='customer', measure='sales', workers=None):
+        return fanout_aggregate(self.filename, group_by, measure, workers)
+
+
+class AsyncAnalytics:
+    # asyncio front of a NormalizedDatabase read pool for serving the ex queries. Each
+    # query runs on one of pool_size worker threads with its own read-only, query_only
+    # connection, so the event loop never blocks on SQLite or pandas. Identical queries
+    # that arrive while one is still running share its result instead of running again.
+    # The service leaves the journal mode alone; build the database with enable_wal()
+    # (build --wal) so the readers never wait on a load.
+
+    def __init__(self, normalized_database_filename, pool_size=8, result_cache=None):
+        self.database = NormalizedDatabase(normalized_database_filename, pool_size=pool_size, result_cache=result_cache)
+        self.executor = concurrent.futures.ThreadPoolExecutor(pool_size)
+        self.executed = 0
+        self.coalesced = 0
+        self._in_flight = {}
+
+    def close(self):
+        self.executor.shutdown()
+        self.database.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        # Waiting for the queries still running happens off the event loop; the database
+        # connection belongs to the loop's thread and is closed there.
+        await asyncio.get_running_loop().run_in_executor(None, self.executor.shutdown)
+        self.close()
+
+    async def run_query(self, name, result_format='dataframe', engine='sql', **params):
+        # ex query `name` with its arguments by name, e.g. run_query('ex1', CustomerName=...).
+        if name not in EX_QUERIES:
+            raise ValueError('unknown query %r' % name)
+        if result_format == 'cursor':
+            raise ValueError("a 'cursor' cannot leave its worker thread")
+        args = inspect.signature(EX_QUERIES[name]).bind(None, **params).args[1:]
+        key = (name, args, result_format, engine)
+        future = self._in_flight.get(key)
+        if future is None:
+            loop = asyncio.get_running_loop()
+            future = loop.run_in_executor(self.executor, functools.partial(
+                self.database.run_query, name, *args, result_format=result_format, engine=engine))
+            self._in_flight[key] = future
+            future.add_done_callback(lambda done: self._in_flight.pop(key, None))
+            self.executed += 1
+        else:
+            self.coalesced += 1
+        return copy_result(await asyncio.shield(future))
+
+async def serve_http(analytics, host='127.0.0.1', port=8000):
+    # Minimal local HTTP stand-in for load testing: GET /exN?CustomerName=... answers
+    # {"columns": {name: [values]}} as JSON, or {"error": ...} with status 400. Returns the
+    # asyncio server; await its serve_forever() to keep answering.
+    async def handle(reader, writer):
+        try:
+            while True:
+                request = await reader.readline()
+                if not request:
+                    break
+                while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                    pass
+                try:
+                    method, target, version = request.decode('latin-1').split()
+                    url = urllib.parse.urlsplit(target)
+                    params = dict(urllib.parse.parse_qsl(url.query))
+                    result = await analytics.run_query(url.path.strip('/'), result_format='columns', **params)
+                    status, body = '200 OK', {'columns': result}
+                except Exception as e:
+                    status, body = '400 Bad Request', {'error': '%s: %s' % (type(e).__name__, e)}
+                payload = json.dumps(body, default=str).encode('utf-8')
+                writer.write(('HTTP/1.1 %s\r\nContent-Type: application/json\r\nContent-Length: %d\r\n\r\n'
+                              % (status, len(payload))).encode('latin-1') + payload)
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    return await asyncio.start_server(handle, host, port)
+
+async def load_test(analytics, queries, concurrency=100, total=1000):
+    # Fires `total` requests drawn round-robin from queries, a list of (name, params)
+    # pairs, with at most `concurrency` in flight, and returns throughput and latencies.
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+
+    async def one(name, params):
+        async with semaphore:
+            start = time.perf_counter()
+            await analytics.run_query(name, **params)
+            latencies.append(time.perf_counter() - start)
+
+    executed, coalesced = analytics.executed, analytics.coalesced
+    start = time.perf_counter()
+    await asyncio.gather(*(one(*queries[i % len(queries)]) for i in range(total)))
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    return {'requests': total, 'seconds': elapsed, 'requests_per_second': total / elapsed,
+            'p50_seconds': latencies[len(latencies) // 2], 'p95_seconds': latencies[int(len(latencies) * 0.95)],
+            'executed': analytics.executed - executed, 'coalesced': analytics.coalesced - coalesced}
+
+
+# Command line entry point, `python -m mini_project2 <command>`. Importing this module
+# stays cheap because pandas, numpy and asyncio are LazyModules; measure_import_time()
+# checks that in a fresh interpreter against STARTUP_BUDGET_SECONDS.
+STARTUP_MODULES = ('pandas', 'numpy', 'asyncio')
+STARTUP_BUDGET_SECONDS = 0.25
+
+def measure_import_time(budget=None, repeat=3):
+    # Best wall time in seconds of importing this module in a fresh interpreter, and which
+    # of STARTUP_MODULES that import loaded. With a budget, raises ValueError when the
+    # import is slower than budget seconds or loads any of them.
+    import subprocess
+    import sys
+    module = os.path.splitext(os.path.basename(__file__))[0]
+    code = ('import sys, time\nstart = time.perf_counter()\nimport %s\nprint(time.perf_counter() - start)\n'
+            'print(" ".join(name for name in %r if name in sys.modules))' % (module, STARTUP_MODULES))
+    best, loaded = None, []
+    for _ in range(repeat):
+        output = subprocess.run([sys.executable, '-c', code], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                capture_output=True, text=True, check=True).stdout.split('\n')
+        best = float(output[0]) if best is None else min(best, float(output[0]))
+        loaded = output[1].split()
+    if budget is not None and (best > budget or loaded):
+        raise ValueError('importing %s took %.3fs against a budget of %.3fs and loaded %s'
+                         % (module, best, budget, ', '.join(loaded) or 'no heavy modules'))
+    return {'seconds': best, 'loaded': loaded}
+
+def write_result(columns, output_format, f):
+    # Writes a run_query(..., result_format='columns') result as CSV with a header row or as JSON.
+    if output_format == 'json':
+        json.dump(columns, f, default=str)
+        f.write('\n')
+        return
+    import csv
+    writer = csv.writer(f, lineterminator='\n')
+    writer.writerow(list(columns))
+    writer.writerows(zip(*columns.values()))
+
+def main(argv=None):
+    import argparse
+    import sys
+    parser = argparse.ArgumentParser(prog='python -m mini_project2',
+                                     description='Normalize sales extracts into SQLite and run the ex queries.')
+    parser.add_argument('--trace', metavar='FILE', help='append a JSON line per traced phase to FILE')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    build = commands.add_parser('build', help='normalize a data file into a new database')
+    build.add_argument('data_filename')
+    build.add_argument('database')
+    build.add_argument('--workers', type=int, help='parse with this many processes (normalize_parallel)')
+    build.add_argument('--bulk-load', action='store_true', help='build under bulk_load_settings()')
+    build.add_argument('--shard-by', choices=SHARD_KEYS, help='split OrderDetail into shards (normalize_sharded)')
+    build.add_argument('--chunk-size', type=int, default=100000)
+    build.add_argument('--wal', action='store_true', help='switch the new database to WAL journaling (enable_wal)')
+
+    append_command = commands.add_parser('append', help='load the lines of a data file a database does not hold yet')
+    append_command.add_argument('data_filename')
+    append_command.add_argument('database')
+    append_command.add_argument('--chunk-size', type=int, default=100000)
+
+    query = commands.add_parser('query', help='run an ex query and print its result')
+    query.add_argument('database')
+    query.add_argument('name', choices=list(EX_QUERIES))
+    query.add_argument('arguments', nargs='*', help='the CustomerName of ex1 and ex2')
+    query.add_argument('--engine', choices=ENGINES, default='sql')
+    query.add_argument('--format', choices=('csv', 'json'), default='csv')
+
+    benchmark = commands.add_parser('benchmark', help='run benchmark_suite() on synthetic extracts')
+    benchmark.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000, 1000000],
+                           help='order lines of each synthetic extract')
+    benchmark.add_argument('--dirname', default='benchmark')
+    benchmark.add_argument('--report', help='JSON report file (DIRNAME/report.json by default)')
+    benchmark.add_argument('--seed', type=int, default=0)
+    benchmark.add_argument('--trace-memory', action='store_true')
+    benchmark.add_argument('--startup', action='store_true',
+                           help='only check the import time against --budget, exit status 1 when over')
+    benchmark.add_argument('--budget', type=float, default=STARTUP_BUDGET_SECONDS, help='seconds, with --startup')
+
+    args = parser.parse_args(argv)
+    if args.command == 'query':
+        if not os.path.exists(args.database):
+            parser.error('no database %s' % args.database)
+        try:
+            inspect.signature(EX_QUERIES[args.name]).bind(None, *args.arguments)
+        except TypeError as e:
+            parser.error('%s: %s' % (args.name, e))
+
+    with tracing() if args.trace else contextlib.nullcontext() as tracer:
+        if args.command == 'build':
+            if os.path.exists(args.database):
+                os.remove(args.database)
+                invalidate_lookups(args.database)
+            if args.shard_by:
+                normalize_sharded(args.data_filename, args.database, by=args.shard_by, workers=args.workers,
+                                  chunk_size=args.chunk_size)
+            elif args.workers:
+                normalize_parallel(args.data_filename, args.database, workers=args.workers,
+                                   chunk_size=args.chunk_size, bulk_load=args.bulk_load)
+            else:
+                normalize(args.data_filename, args.database, chunk_size=args.chunk_size, bulk_load=args.bulk_load)
+            if args.wal:
+                enable_wal(args.database)
+        elif args.command == 'append':
+            print('%d lines loaded' % append(args.data_filename, args.database, chunk_size=args.chunk_size))
+        elif args.command == 'query':
+            with contextlib.closing(sqlite3.connect(args.database)) as conn:
+                sharded = bool(shard_files(conn))
+            with (ShardedDatabase if sharded else NormalizedDatabase)(args.database) as database:
+                result = database.run_query(args.name, *args.arguments, result_format='columns', engine=args.engine)
+            write_result(result, args.format, sys.stdout)
+        elif args.startup:
+            try:
+                print(json.dumps(measure_import_time(args.budget)))
+            except ValueError as e:
+                print(e, file=sys.stderr)
+                return 1
+        else:
+            benchmark_suite(args.sizes, args.dirname, args.report, args.seed, args.trace_memory)
+    if args.trace:
+        with open(args.trace, 'a') as f:
+            f.write(tracer.json_lines())
+    return 0
+
+if __name__ == '__main__':
+    raise SystemExit(main())